@@ -0,0 +1,179 @@
+"""
+Benchmarks of the preprocessing code on a sample of GitHub files.
+
+    python benchmarks.py extractor --csv_file ./data/000000000000.csv --n_files 2000
+    python benchmarks.py extractor --files 'some/project/**/*.py'
+    python benchmarks.py tokenizer --n_files 5000
+    python benchmarks.py visitor --n_files 5000
+"""
+import argparse
+import ast
+import glob
+import json
+import logging
+import time
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from docstring_tokenizer import (fast_tokenize_docstring, regex_tokenize_docstring, tokenize_docstrings,
+                                 tokenize_docstrings_parallel)
+from feature_extractor import get_function_docstring_pairs, get_function_docstring_pairs_fast, tokenize_docstring
+from visitor import ASTVisitor, IterativeASTVisitor
+
+
+def sample_files(csv_file: str = None, n_files: int = 1000, files: str = None) -> List[str]:
+    """Contents of the first `n_files` files of a raw csv dump, or of the files matching a glob."""
+    if files:
+        blobs = []
+        for fname in sorted(glob.glob(files, recursive=True))[:n_files]:
+            with open(fname, 'r', errors='ignore') as f:
+                blobs.append(f.read())
+        return blobs
+    df = pd.read_csv(csv_file, nrows=n_files)
+    return [content for content in df['content'] if isinstance(content, str)]
+
+
+def time_per_file(func, blobs: List[str]):
+    """Seconds spent by `func` on every blob, and its results."""
+    seconds, results = [], []
+    for blob in blobs:
+        start = time.perf_counter()
+        results.append(func(blob))
+        seconds.append(time.perf_counter() - start)
+    return np.array(seconds), results
+
+
+def summary(seconds: np.ndarray) -> dict:
+    ms = seconds * 1000.
+    return {'mean_ms': float(ms.mean()),
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p99_ms': float(np.percentile(ms, 99)),
+            'total_s': float(seconds.sum())}
+
+
+def _extractor_key(pair: tuple) -> tuple:
+    """Name, line number, docstring tokens and api sequence of a pair."""
+    return pair[0], pair[1], pair[4], pair[5]
+
+
+def _extractor_tokens_key(pair: tuple) -> tuple:
+    """`_extractor_key` and the function tokens of a pair."""
+    return _extractor_key(pair) + (pair[3],)
+
+
+def _agreement(base: List[list], fast: List[list], key) -> float:
+    n_functions = sum(len(pairs) for pairs in base)
+    n_same = sum(len(set(map(key, b)) & set(map(key, f))) for b, f in zip(base, fast))
+    return n_same / n_functions if n_functions else 1.
+
+
+def bench_extractor(blobs: List[str]) -> dict:
+    """
+    `get_function_docstring_pairs` against `get_function_docstring_pairs_fast`, per file.
+    `agreement` is the share of functions for which both give the same name, line number,
+    docstring tokens and api sequence, `function_tokens_agreement` the share for which they
+    also give the same function tokens (the source text itself is formatted differently).
+    """
+    base_s, base = time_per_file(get_function_docstring_pairs, blobs)
+    fast_s, fast = time_per_file(get_function_docstring_pairs_fast, blobs)
+    return {'benchmark': 'extractor',
+            'n_files': len(blobs),
+            'n_functions': sum(len(pairs) for pairs in base),
+            'astor': summary(base_s),
+            'single_parse': summary(fast_s),
+            'speedup': float(base_s.sum() / fast_s.sum()),
+            'agreement': _agreement(base, fast, _extractor_key),
+            'function_tokens_agreement': _agreement(base, fast, _extractor_tokens_key)}
+
+
+def bench_tokenizer(blobs: List[str]) -> dict:
+    """
+    Docstring tokenizers on the docstrings of the sample: spaCy one string at a time (as in
+    `tokenize_docstring`), spaCy's `pipe`, `pipe` over worker processes and the fast and regex
+    tokenizers. `identical` is the share of docstrings tokenized like spaCy does.
+    """
+    docstrings = [ast.get_docstring(node) or ''
+                  for blob in blobs for node in _functions(blob)]
+    docstrings = [d.split('\n\n')[0] for d in docstrings if d]
+    results = {'benchmark': 'tokenizer', 'n_docstrings': len(docstrings)}
+    expected = None
+    for name, tokenize in [('spacy', lambda texts: [tokenize_docstring(t) for t in texts]),
+                           ('spacy_pipe', tokenize_docstrings),
+                           ('spacy_pipe_parallel',
+                            lambda texts: list(tokenize_docstrings_parallel(texts, chunk_size=1000))),
+                           ('fast', lambda texts: [fast_tokenize_docstring(t) for t in texts]),
+                           ('regex', lambda texts: [regex_tokenize_docstring(t) for t in texts])]:
+        start = time.perf_counter()
+        tokens = tokenize(docstrings)
+        seconds = time.perf_counter() - start
+        expected = expected or tokens
+        results[name] = {'total_s': seconds,
+                         'us_per_docstring': seconds / max(len(docstrings), 1) * 1e6,
+                         'identical': sum(a == b for a, b in zip(tokens, expected)) / max(len(docstrings), 1)}
+    return results
+
+
+def _functions(blob: str):
+    try:
+        return [node for node in ast.walk(ast.parse(blob)) if isinstance(node, ast.FunctionDef)]
+    except (SyntaxError, ValueError, MemoryError, RecursionError):
+        return []
+
+
+def bench_visitor(blobs: List[str], nested_depth: int = 1000) -> dict:
+    """
+    `ASTVisitor` against `IterativeASTVisitor` on every function of the sample and on a generated
+    expression nested `nested_depth` deep; counts the functions the recursive visitor fails on.
+    """
+    functions = [node for blob in blobs for node in _functions(blob)]
+    functions.append(ast.parse('x = ' + ' + '.join(['a'] * nested_depth)).body[0])
+    results = {'benchmark': 'visitor', 'n_functions': len(functions)}
+    sequences = {}
+    for name, visitor_class in [('recursive', ASTVisitor), ('iterative', IterativeASTVisitor)]:
+        n_failed, sequences[name] = 0, []
+        start = time.perf_counter()
+        for function in functions:
+            visitor = visitor_class()
+            try:
+                visitor.visit(function)
+            except RecursionError:
+                n_failed += 1
+            sequences[name].append(visitor.api_seq)
+        seconds = time.perf_counter() - start
+        results[name] = {'total_s': seconds,
+                         'us_per_function': seconds / len(functions) * 1e6,
+                         'recursion_errors': n_failed}
+    n_same = sum(a == b for a, b in zip(sequences['recursive'], sequences['iterative']))
+    results['identical'] = n_same / len(functions)
+    return results
+
+
+BENCHMARKS = {'extractor': bench_extractor, 'tokenizer': bench_tokenizer, 'visitor': bench_visitor}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Benchmark preprocessing on a sample of GitHub files')
+    parser.add_argument('benchmarks', nargs='+', choices=list(BENCHMARKS))
+    parser.add_argument('--csv_file', default='https://storage.googleapis.com/kubeflow-examples/code_search/raw_data/000000000000.csv',
+                        help='Raw csv dump the sample is read from')
+    parser.add_argument('--files', help='Glob of python files to use instead of the csv dump')
+    parser.add_argument('--n_files', type=int, default=1000, help='Number of files in the sample')
+    parser.add_argument('--out', help='Write results as json to this file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    blobs = sample_files(args.csv_file, args.n_files, args.files)
+    logging.warning(f'Benchmarking on {len(blobs):,} files')
+    results = []
+    for name in args.benchmarks:
+        results.append(BENCHMARKS[name](blobs))
+        logging.warning(json.dumps(results[-1]))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,228 @@
+"""
+Near-duplicate detection over the parquet shards written by `preprocess.py`.
+
+Every function gets a MinHash signature of the shingles (token n-grams) of its `function_tokens`.
+Signatures are cut into bands, functions sharing a band are candidates, and candidates whose
+signatures agree on at least `threshold` of their positions (an estimate of the Jaccard
+similarity of their shingles) are put in the same cluster. Each complete shard (see
+`preprocess.list_shards`) gets a `cluster_id` column: the row id (position in the shards, in
+order) of the first function of its cluster, so `df[df.cluster_id == df.row_id]` keeps one
+representative per cluster. Rows superseded by a later version of their file (see
+`preprocess.load_shards`) are not clustered and get a `cluster_id` of -1.
+
+The shards clustered are listed in `CLUSTERS.json`, which `preprocess.py` removes when it appends
+shards: the cluster ids are then stale until `dedup.py` runs again.
+
+    python dedup.py --shards ./data/processed_shards
+"""
+import argparse
+import json
+import logging
+import zlib
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from general_utils import parallel_imap
+from preprocess import CLUSTERS_FILE, list_shards, load_manifest
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def permutations(num_perm: int, seed: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """Parameters (a, b) of the `num_perm` hash functions (a * x + b) mod p of the signatures."""
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+    b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def shingle_hashes(tokens: List[str], ngram: int = 3) -> np.ndarray:
+    """32 bit hashes of the token n-grams of a function (a single shingle when it is shorter)."""
+    hashes = np.array([zlib.crc32(token.encode('utf-8', errors='replace')) for token in tokens] or [0],
+                      dtype=np.uint64)
+    if len(hashes) < ngram:
+        ngram = len(hashes)
+    shingles = np.zeros(len(hashes) - ngram + 1, dtype=np.uint64)
+    for i in range(ngram):
+        shingles = shingles * np.uint64(1000003) + hashes[i:len(hashes) - ngram + 1 + i]
+    return np.unique(shingles & MAX_HASH)
+
+
+def minhash(tokens: List[str], a: np.ndarray, b: np.ndarray, ngram: int = 3) -> np.ndarray:
+    """MinHash signature, `len(a)` uint32 values."""
+    shingles = shingle_hashes(tokens, ngram)
+    return (((np.outer(a, shingles) + b[:, None]) % MERSENNE_PRIME) & MAX_HASH).min(axis=1).astype(np.uint32)
+
+
+def band_keys(signatures: np.ndarray, bands: int) -> np.ndarray:
+    """[n x bands] uint64 hash of each band of the signatures."""
+    n, num_perm = signatures.shape
+    rows = num_perm // bands
+    keys = np.zeros((n, bands), dtype=np.uint64)
+    for i in range(rows):
+        keys = keys * np.uint64(0x100000001b3) + signatures[:, i:bands * rows:rows].astype(np.uint64)
+    return keys
+
+
+def signature_file(shard: Path) -> Path:
+    return shard.with_name(shard.name.replace('.parquet', '.minhash.npy'))
+
+
+def shard_signatures(task: tuple) -> np.ndarray:
+    """Worker: MinHash signatures of a shard, saved next to it, and their band keys."""
+    shard, num_perm, bands, ngram, seed = task
+    a, b = permutations(num_perm, seed)
+    tokens = pd.read_parquet(shard, columns=['function_tokens'])['function_tokens']
+    signatures = np.empty((len(tokens), num_perm), dtype=np.uint32)
+    for i, function_tokens in enumerate(tokens):
+        signatures[i] = minhash(function_tokens.split(), a, b, ngram)
+    np.save(signature_file(shard), signatures)
+    return band_keys(signatures, bands)
+
+
+class UnionFind:
+    def __init__(self, n: int):
+        self.parent = np.arange(n)
+
+    def find(self, i: int) -> int:
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i: int, j: int) -> None:
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            # the smallest row id is the root, i.e. the representative of the cluster
+            self.parent[max(i, j)] = min(i, j)
+
+    def roots(self) -> np.ndarray:
+        # parents always have smaller ids, so pointer jumping converges to the roots
+        parent = self.parent
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                return parent
+            parent = grandparent
+
+
+def latest_rows(shard_dir: str, shards: List[Path]) -> np.ndarray:
+    """Whether each row of the shards (in order) is of the latest version of its file."""
+    manifest = load_manifest(shard_dir)
+    latest = []
+    for i, shard in enumerate(shards):
+        files = pd.read_parquet(shard, columns=['nwo', 'path'])
+        latest.append(np.array([manifest[(nwo, path)][1] == i for nwo, path in zip(files['nwo'], files['path'])],
+                               dtype=bool))
+    return np.concatenate(latest) if latest else np.zeros(0, dtype=bool)
+
+
+def near_duplicate_clusters(shards: List[Path],
+                            num_perm: int = 128,
+                            bands: int = 16,
+                            threshold: float = 0.8,
+                            ngram: int = 3,
+                            seed: int = 1,
+                            processes: int = None,
+                            active: np.ndarray = None) -> np.ndarray:
+    """
+    Cluster id of every row of the shards (in order), see the module docstring.
+
+    Parameters
+    ==========
+    shards : List[Path]
+        Parquet shards with a `function_tokens` column.
+    num_perm : int
+        Length of the MinHash signatures.
+    bands : int
+        Number of LSH bands, of `num_perm // bands` rows each. Functions with a Jaccard similarity
+        s become candidates with probability 1 - (1 - s^rows)^bands.
+    threshold : float
+        Minimum share of equal signature values for candidates to be clustered.
+    ngram : int
+        Number of tokens per shingle.
+    processes : int
+        Number of worker processes, defaults to the number of cpus.
+    active : np.ndarray
+        Boolean mask of the rows to cluster (e.g. `latest_rows`), all by default. The other rows
+        get a cluster id of -1.
+    """
+    assert num_perm % bands == 0, f'num_perm ({num_perm}) must be a multiple of bands ({bands})'
+    tasks = ((shard, num_perm, bands, ngram, seed) for shard in shards)
+    keys = np.concatenate(list(parallel_imap(shard_signatures, tasks, processes=processes,
+                                             max_in_flight=processes)))
+    signatures = [np.load(signature_file(shard), mmap_mode='r') for shard in shards]
+    shard_offsets = np.cumsum([0] + [len(s) for s in signatures])
+    n = len(keys)
+    logging.warning(f'Computed MinHash signatures of {n:,} functions')
+
+    def signature(i):
+        s = np.searchsorted(shard_offsets, i, side='right') - 1
+        return signatures[s][i - shard_offsets[s]]
+
+    rows = np.arange(n) if active is None else np.flatnonzero(active)
+    clusters = UnionFind(n)
+    n_candidates = 0
+    for band in range(bands):
+        order = rows[np.argsort(keys[rows, band], kind='stable')]
+        sorted_keys = keys[order, band]
+        same = np.flatnonzero(sorted_keys[1:] == sorted_keys[:-1]) + 1
+        # each candidate is compared to the first row of its bucket
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        first = order[starts[np.searchsorted(starts, same, side='right') - 1]]
+        for i, j in zip(first, order[same]):
+            if clusters.find(i) == clusters.find(j):
+                continue
+            n_candidates += 1
+            if (signature(i) == signature(j)).mean() >= threshold:
+                clusters.union(i, j)
+    cluster_ids = clusters.roots()
+    if active is not None:
+        cluster_ids[~active] = -1
+    logging.warning(f'Checked {n_candidates:,} candidate pairs, {len(np.unique(cluster_ids[rows])):,} clusters '
+                    f'for {len(rows):,} functions')
+    return cluster_ids
+
+
+def write_clusters(shards: List[Path], cluster_ids: np.ndarray, params: dict = None) -> None:
+    """
+    Add `row_id` and `cluster_id` columns to the shards, one shard in memory at a time, and list
+    them (with the clustering `params`) in the `CLUSTERS.json` of their directory.
+    """
+    offset = 0
+    for shard in shards:
+        df = pd.read_parquet(shard)
+        df['row_id'] = np.arange(offset, offset + len(df))
+        df['cluster_id'] = cluster_ids[offset:offset + len(df)]
+        df.to_parquet(shard, index=False)
+        signature_file(shard).unlink()
+        offset += len(df)
+    if shards:
+        with open(shards[0].parent / CLUSTERS_FILE, 'w') as f:
+            json.dump({'shards': [shard.name for shard in shards], 'params': params or {}}, f, indent=2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Cluster near duplicate functions of preprocessed parquet shards')
+    parser.add_argument('--shards', required=True, help='Directory of the parquet shards')
+    parser.add_argument('--num_perm', type=int, default=128, help='Length of the MinHash signatures')
+    parser.add_argument('--bands', type=int, default=16, help='Number of LSH bands')
+    parser.add_argument('--threshold', type=float, default=0.8, help='Estimated Jaccard similarity of duplicates')
+    parser.add_argument('--ngram', type=int, default=3, help='Tokens per shingle')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes, all cpus by default')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    shards = list_shards(args.shards)
+    cluster_ids = near_duplicate_clusters(shards, args.num_perm, args.bands, args.threshold, args.ngram,
+                                          processes=args.processes, active=latest_rows(args.shards, shards))
+    write_clusters(shards, cluster_ids, {'num_perm': args.num_perm, 'bands': args.bands,
+                                         'threshold': args.threshold, 'ngram': args.ngram})
@@ -0,0 +1,156 @@
+"""
+Docstring tokenization, as done by `feature_extractor.tokenize_docstring`, for large batches of
+docstrings and for single queries.
+
+spaCy's tokenizer splits a text on whitespace and then tokenizes every chunk on its own (special
+cases, prefixes, suffixes and infixes), so a chunk of plain letters or digits that is not a
+special case is always a single token. `fast_tokenize_docstring` returns such chunks as
+they are and only hands the other chunks to spaCy, memoized, which gives the same tokens as
+spaCy in a fraction of the time.
+"""
+import logging
+import re
+from functools import lru_cache
+from typing import List, Iterable, Iterator
+
+from more_itertools import chunked
+
+from general_utils import parallel_imap
+
+SIMPLE_CHUNK = re.compile(r'[A-Za-z_]+|[0-9]+')
+# the part of spaCy's rules used by `regex_tokenize_docstring`, which does not need spaCy at all
+PREFIXES = re.compile(r'''^[\[({<"'`*~#$%&@-]''')
+SUFFIXES = re.compile(r'''(?:[\])}>"'`*,;:!?%]|(?<=[a-z0-9])\.|\.\.+)$''')
+INFIXES = re.compile(r'''(?<=[A-Za-z])(?:-|--|/|=|\.\.+|,)(?=[A-Za-z])|(?<=[a-z])\.(?=[A-Z])''')
+
+_nlp = None
+
+
+def get_nlp():
+    """spaCy English model, loaded once per process."""
+    global _nlp
+    if _nlp is None:
+        import en_core_web_sm
+        _nlp = en_core_web_sm.load()
+    return _nlp
+
+
+@lru_cache(maxsize=None)
+def special_cases() -> frozenset:
+    nlp = get_nlp()
+    exceptions = getattr(nlp.Defaults, 'tokenizer_exceptions', None) or getattr(nlp.tokenizer, 'rules', None) or {}
+    return frozenset(exceptions)
+
+
+@lru_cache(maxsize=1 << 16)
+def _spacy_chunk(chunk: str) -> tuple:
+    return tuple(token.text.lower() for token in get_nlp().tokenizer(chunk) if not token.is_space)
+
+
+def _regex_chunk(chunk: str) -> List[str]:
+    prefixes, suffixes = [], []
+    while chunk:
+        match = PREFIXES.search(chunk)
+        if not match or len(chunk) == 1:
+            break
+        prefixes.append(match.group())
+        chunk = chunk[match.end():]
+    while chunk:
+        match = SUFFIXES.search(chunk)
+        if not match or match.start() == 0:
+            break
+        suffixes.insert(0, match.group())
+        chunk = chunk[:match.start()]
+    middle, start = [], 0
+    for match in INFIXES.finditer(chunk):
+        middle.extend([chunk[start:match.start()], match.group()])
+        start = match.end()
+    middle.append(chunk[start:])
+    return [token.lower() for token in prefixes + middle + suffixes if token and not token.isspace()]
+
+
+def fast_tokenize_docstring(text: str, use_spacy: bool = True) -> List[str]:
+    """
+    Same tokens as `feature_extractor.tokenize_docstring`. With `use_spacy=False` the chunks
+    that are not plain words go through a small set of regular expressions instead of spaCy,
+    which is an approximation: check it with `verify_tokenizer` before using it.
+    """
+    tokens = []
+    exceptions = special_cases() if use_spacy else ()
+    for chunk in text.split():
+        if SIMPLE_CHUNK.fullmatch(chunk) and chunk not in exceptions:
+            tokens.append(chunk.lower())
+        elif use_spacy:
+            tokens.extend(_spacy_chunk(chunk))
+        else:
+            tokens.extend(_regex_chunk(chunk))
+    return tokens
+
+
+def regex_tokenize_docstring(text: str) -> List[str]:
+    """Tokenize without spaCy, see `fast_tokenize_docstring`."""
+    return fast_tokenize_docstring(text, use_spacy=False)
+
+
+def tokenize_docstrings(texts: Iterable[str], batch_size: int = 1000) -> List[List[str]]:
+    """Tokenize docstrings with spaCy's batched `pipe`, same tokens as `tokenize_docstring`."""
+    return [[token.text.lower() for token in doc if not token.is_space]
+            for doc in get_nlp().tokenizer.pipe(texts, batch_size=batch_size)]
+
+
+def tokenize_docstrings_parallel(texts: Iterable[str],
+                                 processes: int = None,
+                                 chunk_size: int = 10000,
+                                 tokenizer: str = 'spacy') -> Iterator[List[str]]:
+    """
+    Tokenize docstrings in worker processes, lazily and in order; each worker loads the
+    spaCy model once.
+
+    Parameters
+    ==========
+    texts : Iterable[str]
+        Docstrings.
+    processes : int
+        Number of worker processes, defaults to the number of cpus.
+    chunk_size : int
+        Number of docstrings sent to a worker at a time.
+    tokenizer : str
+        'spacy' for `tokenize_docstrings`, 'fast' for `fast_tokenize_docstring` or 'regex' for
+        `regex_tokenize_docstring`.
+
+    Returns
+    =======
+    Iterator of the tokens of each docstring.
+    """
+    func = {'spacy': tokenize_docstrings, 'fast': _fast_tokenize_list, 'regex': _regex_tokenize_list}[tokenizer]
+    for tokens in parallel_imap(func, chunked(texts, chunk_size), processes=processes):
+        yield from tokens
+
+
+def _fast_tokenize_list(texts: List[str]) -> List[List[str]]:
+    return [fast_tokenize_docstring(text) for text in texts]
+
+
+def _regex_tokenize_list(texts: List[str]) -> List[List[str]]:
+    return [regex_tokenize_docstring(text) for text in texts]
+
+
+def verify_tokenizer(texts: List[str], tokenizer=regex_tokenize_docstring, max_examples: int = 20):
+    """
+    Compare a tokenizer to spaCy's on a corpus of docstrings.
+
+    Returns
+    =======
+    Tuple(share of docstrings with identical tokens, list of (text, spacy tokens, tokens) that differ)
+    """
+    expected = tokenize_docstrings_parallel(texts)
+    n_same, examples = 0, []
+    for text, spacy_tokens in zip(texts, expected):
+        tokens = tokenizer(text)
+        if tokens == spacy_tokens:
+            n_same += 1
+        elif len(examples) < max_examples:
+            examples.append((text, spacy_tokens, tokens))
+    share = n_same / len(texts) if texts else 1.
+    logging.warning(f'{share:.4%} of {len(texts):,} docstrings tokenized identically')
+    return share, examples
@@ -0,0 +1,122 @@
+"""
+Evaluation of code search, as in "6 - Eval metrics.ipynb": the embedding of each description is a
+query, and the only relevant result is the code embedding of the same row. The queries are run in
+batches against the search index and against an exact search of the same vectors, so that the
+quality of the embeddings (metrics of the exact search) is reported separately from the recall of
+the approximate index.
+
+    python evaluate.py --code_vecs ./data/code2emb/test_code_vecs.npy \
+        --doc_vecs ./data/lang_model_emb/avg_emb_dim500_test_v2.npy --n_queries 10000
+"""
+import argparse
+import json
+import logging
+import time
+from typing import List, Tuple
+
+import numpy as np
+
+from search_index import ExactIndex, SearchIndex, create_index
+
+
+def neighbors_matrix(results: List[Tuple[np.ndarray, np.ndarray]], k: int) -> np.ndarray:
+    """[n_queries x k] ids from `knnQueryBatch` results, padded with -1 when fewer than k were found."""
+    predictions = np.full((len(results), k), -1, dtype=np.int64)
+    for i, (idxs, _) in enumerate(results):
+        predictions[i, :len(idxs)] = idxs[:k]
+    return predictions
+
+
+def retrieval_metrics(predictions: np.ndarray, real: np.ndarray) -> dict:
+    """
+    Mean ACC, MRR, MAP and NDCG of [n_queries x k] predicted ids when each query has one relevant
+    id (`real`), the same values as the per-query `ACC`, `MRR`, `MAP` and `NDCG` functions the
+    notebook used to define.
+    """
+    hits = predictions == real[:, None]
+    found = hits.any(axis=1)
+    rank = hits.argmax(axis=1)
+    reciprocal_rank = np.where(found, 1. / (rank + 1), 0.)
+    return {'ACC': float(found.mean()),
+            'MRR': float(reciprocal_rank.mean()),
+            # with a single relevant id, the average precision is its reciprocal rank
+            'MAP': float(reciprocal_rank.mean()),
+            'NDCG': float(np.where(found, 1. / np.log2(rank + 2), 0.).mean())}
+
+
+def evaluate_search(code_vecs: np.ndarray,
+                    doc_vecs: np.ndarray,
+                    search_index: SearchIndex = None,
+                    backend: str = None,
+                    k: int = 10,
+                    num_threads: int = 0,
+                    **index_params) -> dict:
+    """
+    Metrics of searching `code_vecs` with `doc_vecs` (row i of both is a description and its code).
+
+    Parameters
+    ==========
+    search_index : SearchIndex or nmslib object
+        Index of `code_vecs`, built with `backend` and `index_params` (see `search_index.create_index`)
+        when not given.
+    k : int
+        Number of results per query.
+    num_threads : int
+        Threads running the queries, 0 for one per cpu.
+
+    Returns
+    =======
+    {'approximate': metrics of the index, 'exact': metrics of the exact search, 'ann_recall': share
+    of the exact k nearest neighbors found by the index, and timings}
+    """
+    results = {'n_queries': len(doc_vecs), 'k': k}
+    real = np.arange(len(doc_vecs))
+    if search_index is None:
+        start = time.perf_counter()
+        search_index = create_index(code_vecs, backend, **index_params)
+        results['build_s'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    approximate = neighbors_matrix(search_index.knnQueryBatch(doc_vecs, k=k, num_threads=num_threads), k)
+    results['query_s'] = time.perf_counter() - start
+    start = time.perf_counter()
+    exact_index = ExactIndex().add(code_vecs).build()
+    exact = neighbors_matrix(exact_index.knnQueryBatch(doc_vecs, k=k, num_threads=num_threads), k)
+    results['exact_query_s'] = time.perf_counter() - start
+
+    results['approximate'] = retrieval_metrics(approximate, real)
+    results['exact'] = retrieval_metrics(exact, real)
+    # -1 pads the queries with fewer than k results, it is not a neighbor
+    found = [len(set(a[a >= 0]) & set(e[e >= 0])) for a, e in zip(approximate, exact)]
+    results['ann_recall'] = float(np.sum(found) / max(np.count_nonzero(exact >= 0), 1))
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Evaluate code search on descriptions and code embeddings of the same functions')
+    parser.add_argument('--code_vecs', required=True, help='.npy file of code embeddings')
+    parser.add_argument('--doc_vecs', required=True, help='.npy file of description embeddings, same rows')
+    parser.add_argument('--n_queries', type=int, default=10000, help='Number of rows sampled, all if 0')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the sample')
+    parser.add_argument('--backend', default=None, help='Search index backend, nmslib (or ivf without it) by default')
+    parser.add_argument('--k', type=int, default=10, help='Results per query')
+    parser.add_argument('--threads', type=int, default=0, help='Query threads, one per cpu by default')
+    parser.add_argument('--out', help='Write results as json to this file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    code_vecs = np.load(args.code_vecs, mmap_mode='r')
+    doc_vecs = np.load(args.doc_vecs, mmap_mode='r')
+    assert len(code_vecs) == len(doc_vecs), f'{len(code_vecs):,} code vectors for {len(doc_vecs):,} descriptions'
+    rows = np.arange(len(code_vecs))
+    if args.n_queries and args.n_queries < len(rows):
+        rows = np.sort(np.random.RandomState(args.seed).choice(rows, args.n_queries, replace=False))
+    logging.warning(f'Evaluating on {len(rows):,} functions')
+    results = evaluate_search(np.asarray(code_vecs[rows]), np.asarray(doc_vecs[rows]), backend=args.backend,
+                              k=args.k, num_threads=args.threads)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
@@ -1,18 +1,27 @@
 import ast
 import re
+import sys
 from typing import List
 
 import astor
 import en_core_web_sm
 import pandas as pd
 from nltk import RegexpTokenizer
-from visitor import ASTVisitor
+from visitor import ASTVisitor, IterativeASTVisitor
 
 EN = en_core_web_sm.load()
 
 r1 = re.compile(r"([A-Z]+)([A-Z][a-z])")
 r2 = re.compile(r"([a-z\d])([A-Z])")
 
+# lines as counted by the parser: \r\n, \r and \n end a line, \f and the like do not
+LINES = re.compile(r'[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+$')
+# comments, skipping over string literals that contain a '#'
+COMMENTS = re.compile(r'''("""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')|#[^\r\n]*''')
+CODE_TOKENS = re.compile(r'\w+')
+# node end positions, needed to slice the source of a function, are only set from python 3.8
+HAS_END_POSITIONS = sys.version_info >= (3, 8)
+
 
 def underscore(word):
     if not isinstance(word, str):
@@ -68,6 +77,91 @@ def get_function_docstring_pairs(blob):
     return pairs
 
 
+def _segment(lines, start, start_col, end, end_col):
+    """Source between two (1-based line, utf-8 byte column) positions."""
+    if start == end:
+        return lines[start - 1].encode('utf-8')[start_col:end_col].decode('utf-8')
+    first = lines[start - 1].encode('utf-8')[start_col:].decode('utf-8')
+    last = lines[end - 1].encode('utf-8')[:end_col].decode('utf-8')
+    return first + ''.join(lines[start:end - 1]) + last
+
+
+def _visit_function(visitor, f, body):
+    """Visit a function like `visitor.visit` would, but only the given statements of its body."""
+    visitor.visit(f.args)
+    for node in body:
+        visitor.visit(node)
+    for node in f.decorator_list:
+        visitor.visit(node)
+    visitor.visit(f.returns)
+
+
+def get_function_docstring_pairs_fast(blob):
+    """
+    Pairs like the ones of `get_function_docstring_pairs`, from a single parse of the blob.
+
+    The source of each function is sliced out of the blob with the node positions instead of
+    being regenerated by astor, the docstring is cut out by its node position and the api
+    sequence is collected from the parsed function (with `IterativeASTVisitor`, so deeply nested
+    code does not hit the recursion limit), so nothing is parsed twice.
+
+    Name, line number and docstring tokens are the same, but the other fields differ:
+
+    - `original_function` keeps the formatting of the blob (comments are left out of the
+      function tokens, like astor does).
+    - `function_tokens` keep the literals as written, where astor normalized them: `0o7777`
+      and `0xF` give the tokens `0o7777` and `0xF` instead of `4095` and `15`, and string
+      literals keep their escapes. This changes the tokens of about 10% of functions.
+    - `api_sequence` never includes the docstring, which the astor version keeps when the
+      docstring regenerated by astor is quoted differently from the original one.
+
+    Rows of the two versions should not be mixed (see `preprocess.EXTRACTOR_VERSION`).
+    """
+    if not HAS_END_POSITIONS:
+        return get_function_docstring_pairs(blob)
+
+    pairs = []
+    try:
+        module = ast.parse(blob)
+        lines = LINES.findall(blob)
+        functions: List[ast.FunctionDef] = [node for node in module.body if isinstance(node, ast.FunctionDef)]
+        for _class in module.body:
+            if isinstance(_class, ast.ClassDef):
+                functions.extend([node for node in _class.body if isinstance(node, ast.FunctionDef)])
+
+        for f in functions:
+            start = min([f.lineno] + [d.lineno for d in f.decorator_list])
+            indent = len(lines[start - 1]) - len(lines[start - 1].lstrip())
+            source = _segment(lines, start, 0, f.end_lineno, f.end_col_offset)
+            source = '\n'.join(line[indent:] if not line[:indent].strip() else line
+                               for line in source.splitlines()) + '\n'
+
+            docstring = ast.get_docstring(f) or ''
+            body = f.body
+            function = source
+            if docstring:
+                node = f.body[0]
+                body = f.body[1:]
+                function = (_segment(lines, start, 0, node.lineno, node.col_offset) +
+                            _segment(lines, node.end_lineno, node.end_col_offset, f.end_lineno, f.end_col_offset))
+
+            visitor = IterativeASTVisitor()
+            _visit_function(visitor, f, body)
+            underscored_function_name = underscore(f.name)
+            pairs.append((underscored_function_name,
+                          f.lineno,
+                          source,
+                          ' '.join(CODE_TOKENS.findall(COMMENTS.sub(lambda m: m.group(1) or '', function))),
+                          ' '.join(tokenize_docstring(docstring.split('\n\n')[0])),
+                          ' '.join(
+                              [underscore(str(token)) for token in visitor.api_seq]),
+                          ' '.join(token for token in underscored_function_name.split("_") if token)
+                          ))
+    except (AssertionError, MemoryError, SyntaxError, UnicodeEncodeError, OverflowError, RecursionError):
+        pass
+    return pairs
+
+
 def get_function_docstring_pairs_list(blob_list):
     """apply the function `get_function_docstring_pairs` on a list of blobs"""
     return [get_function_docstring_pairs(b) for b in blob_list]
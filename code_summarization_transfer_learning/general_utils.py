@@ -1,14 +1,26 @@
+import json
 import logging
+import mmap
 import pickle
+import time
+import traceback
+import zlib
+from collections import deque
 from itertools import chain
 from math import ceil
+from multiprocessing import Process, Pipe, cpu_count
+from multiprocessing.connection import wait
 from pathlib import Path
-from typing import List, Callable, Any
+from typing import List, Callable, Any, Iterable, Iterator, Sequence, Tuple
 
-import nmslib
+import numpy as np
 import wget
 from more_itertools import chunked
-from pathos.multiprocessing import Pool, cpu_count
+
+try:
+    import nmslib
+except ImportError:  # search_index.py has other backends
+    nmslib = None
 
 
 def save_file_pickle(fname: str, obj: Any):
@@ -89,24 +101,380 @@ def read_training_files(data_path: str):
     return tv_enc, h_enc, tv_dec, h_dec, tv_api, h_api, tv_fun, h_fun
 
 
+def line_offsets(fname: str, chunk_size: int = 1 << 24) -> np.ndarray:
+    """Byte offsets of the lines of a text file: line i spans offsets[i]:offsets[i + 1]."""
+    starts = [np.zeros(1, dtype='int64')]
+    pos = 0
+    with open(fname, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            starts.append(newlines.astype('int64') + (pos + 1))
+            pos += len(chunk)
+    offsets = np.concatenate(starts)
+    if offsets[-1] != pos:  # last line has no trailing newline
+        offsets = np.append(offsets, pos)
+    return offsets
+
+
+class LineIndexedFile(Sequence):
+    """
+    Lines of a text file, read on demand from a memory map through an index of line offsets.
+    Lines are decoded like `open(fname, errors='ignore').readlines()` does (keeping the newline),
+    but only when accessed, and only '\n' ends a line.
+
+    Parameters
+    ==========
+    fname : str
+        Text file.
+    cache_index : bool
+        Save the line offsets next to the file (`<fname>.lineidx.npy`) and reuse them while the
+        file is not modified.
+    """
+
+    def __init__(self, fname: str, cache_index: bool = False):
+        self.fname = str(fname)
+        index_file = Path(self.fname + '.lineidx.npy')
+        if cache_index and index_file.exists() and index_file.stat().st_mtime >= Path(self.fname).stat().st_mtime:
+            self.offsets = np.load(index_file)
+        else:
+            self.offsets = line_offsets(self.fname)
+            if cache_index:
+                np.save(index_file, self.offsets)
+        self.buf = b''
+        if self.offsets[-1]:  # empty files cannot be mapped
+            with open(self.fname, 'rb') as f:
+                self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def _line(self, i: int) -> str:
+        line = self.buf[self.offsets[i]:self.offsets[i + 1]].decode('utf-8', errors='ignore')
+        # universal newlines, as in text mode; a '\r' alone in the middle of a line does not split it
+        if line.endswith('\r\n'):
+            return line[:-2] + '\n'
+        return line[:-1] + '\n' if line.endswith('\r') else line
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._line(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f'line {i} out of range for {self.fname} ({len(self):,} lines)')
+        return self._line(i)
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self._line(i)
+
+
+class ConcatLines(Sequence):
+    """Several sequences of lines seen as one, without copying them (e.g. train + valid)."""
+
+    def __init__(self, *parts: Sequence):
+        self.parts = parts
+        self.starts = np.cumsum([0] + [len(part) for part in parts])
+
+    def __len__(self) -> int:
+        return int(self.starts[-1])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f'line {i} out of range ({len(self):,} lines)')
+        part = int(np.searchsorted(self.starts, i, side='right')) - 1
+        return self.parts[part][i - int(self.starts[part])]
+
+    def __iter__(self) -> Iterator[str]:
+        for part in self.parts:
+            yield from part
+
+
+class ParallelTextFiles:
+    """
+    Aligned rows of parallel text files, e.g. the `train.function`, `train.docstring`,
+    `train.api_seq` and `train.function_name` files, where line i of every file describes the
+    same function.
+
+    Parameters
+    ==========
+    files : dict
+        Name of each column -> text file (or sequence of lines, e.g. a `ConcatLines`).
+    """
+
+    def __init__(self, files: dict, cache_index: bool = False):
+        self.columns = {name: f if isinstance(f, Sequence) and not isinstance(f, (str, Path))
+                        else LineIndexedFile(f, cache_index)
+                        for name, f in files.items()}
+        lengths = {name: len(lines) for name, lines in self.columns.items()}
+        assert len(set(lengths.values())) <= 1, f'Parallel files have different numbers of lines: {lengths}'
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, i) -> dict:
+        """Row i as a dict of column -> line, or a dict of column -> list of lines for a slice."""
+        return {name: lines[i] for name, lines in self.columns.items()}
+
+    def __iter__(self) -> Iterator[dict]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def iter_batches(self, batch_size: int = 10000) -> Iterator[dict]:
+        """Consecutive slices of `batch_size` rows."""
+        for start in range(0, len(self), batch_size):
+            yield self[start:start + batch_size]
+
+
+TRAINING_COLUMNS = ['function', 'docstring', 'api_seq', 'function_name']
+
+
+def open_training_files(data_path: str, cache_index: bool = False) -> dict:
+    """
+    Lazy version of `read_training_files`: {'train': ..., 'valid': ..., 'test': ...} of
+    `ParallelTextFiles` over the function, docstring, api_seq and function_name files.
+    """
+    PATH = Path(data_path)
+    return {split: ParallelTextFiles({column: PATH / f'{split}.{column}' for column in TRAINING_COLUMNS},
+                                     cache_index)
+            for split in ['train', 'valid', 'test']}
+
+
+def read_training_files_lazy(data_path: str, cache_index: bool = False):
+    """
+    Same return values as `read_training_files`, as sequences of lines read on demand from
+    memory mapped files instead of lists, and train + valid concatenated without a copy.
+    """
+    splits = open_training_files(data_path, cache_index)
+    train, valid, test = splits['train'].columns, splits['valid'].columns, splits['test'].columns
+    tv = {column: ConcatLines(train[column], valid[column]) for column in TRAINING_COLUMNS}
+    logging.warning(f'Num rows for training + validation input: {len(tv["function"]):,}')
+    logging.warning(f'Num rows for holdout input: {len(test["function"]):,}')
+    return (tv['function'], test['function'], tv['docstring'], test['docstring'],
+            tv['api_seq'], test['api_seq'], tv['function_name'], test['function_name'])
+
+
+class ParallelStats:
+    """Counters of a `parallel_imap` run."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.restarts = 0
+
+    @property
+    def throughput(self) -> float:
+        """Tasks finished per second."""
+        return (self.completed + self.failed + self.timed_out) / max(time.time() - self.start, 1e-9)
+
+    def __repr__(self):
+        return (f'{self.completed:,} completed, {self.failed:,} failed, {self.timed_out:,} timed out '
+                f'of {self.submitted:,} submitted ({self.throughput:,.1f} tasks/s, {self.restarts} worker restarts)')
+
+
+def _parallel_worker(func: Callable, conn) -> None:
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        idx, unit = task
+        try:
+            result = (True, func(unit))
+        except Exception:
+            result = (False, traceback.format_exc())
+        conn.send((idx, result))
+
+
+class _Worker:
+    def __init__(self, func: Callable):
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=_parallel_worker, args=(func, child_conn), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None  # index of the task being run
+        self.deadline = None
+
+    def stop(self, kill: bool = False) -> None:
+        if kill:
+            self.process.kill()
+        else:
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        self.process.join()
+        self.conn.close()
+
+
+def parallel_imap(func: Callable,
+                  data: Iterable[Any],
+                  processes: int = None,
+                  max_in_flight: int = None,
+                  timeout: float = None,
+                  ordered: bool = True,
+                  errors: str = 'raise',
+                  default: Any = None,
+                  stats: ParallelStats = None,
+                  log_every: float = None) -> Iterator[Any]:
+    """
+    Lazily apply a function to every element of an iterable in worker processes.
+
+    Elements are pulled from `data` only when there is room for them, so neither the inputs nor
+    the results of the whole iterable are held in memory; pass small work units (e.g. with
+    `more_itertools.chunked`). A task that runs longer than `timeout` seconds, or whose worker
+    dies (e.g. a segfault or memory error while parsing), has its worker killed and replaced,
+    without affecting the other tasks.
+
+    Parameters
+    ==========
+    func : Callable
+        Function applied to each element, it has to be picklable.
+    data : Iterable[Any]
+        Work units.
+    processes : int
+        Number of worker processes, defaults to the number of cpus.
+    max_in_flight : int
+        Maximum number of tasks submitted but not yet yielded, defaults to 4 per worker.
+    timeout : float
+        Seconds after which a task is abandoned, no limit by default.
+    ordered : bool
+        Yield results in the order of `data` (default) or as they complete.
+    errors : str
+        'raise' to raise on the first failed or timed out task, 'ignore' to yield `default`
+        in its place.
+    stats : ParallelStats
+        Counters updated while iterating.
+    log_every : float
+        Log the counters every `log_every` seconds.
+
+    Returns
+    =======
+    Iterator of `func(element)`
+    """
+    assert errors in ('raise', 'ignore'), f'Unknown errors mode {errors}'
+    processes = processes or cpu_count()
+    max_in_flight = max(max_in_flight or 4 * processes, processes)
+    stats = stats if stats is not None else ParallelStats()
+    data = iter(data)
+    workers = [_Worker(func) for _ in range(processes)]
+    queued = deque()  # (index, unit) waiting for a worker
+    results = {}  # index -> result, finished but not yielded yet
+    next_index = 0  # index of the next element of data
+    next_yield = 0  # index of the next result to yield, when ordered
+    exhausted = False
+    last_log = time.time()
+
+    def failed(idx, message, exc_type):
+        if errors == 'raise':
+            raise exc_type(message)
+        logging.warning(message)
+        results[idx] = default
+
+    try:
+        while True:
+            # pull new work while there is room for it
+            while not exhausted and len(queued) + sum(w.task is not None for w in workers) + len(results) < max_in_flight:
+                try:
+                    queued.append((next_index, next(data)))
+                except StopIteration:
+                    exhausted = True
+                    break
+                next_index += 1
+                stats.submitted += 1
+            for worker in workers:
+                if worker.task is None and queued:
+                    idx, unit = queued.popleft()
+                    worker.conn.send((idx, unit))
+                    worker.task = idx
+                    worker.deadline = time.time() + timeout if timeout else None
+
+            busy = [w for w in workers if w.task is not None]
+            if not busy and not queued and not results and exhausted:
+                return
+
+            if busy:
+                deadlines = [w.deadline for w in busy if w.deadline is not None]
+                wait_for = max(min(deadlines) - time.time(), 0) if deadlines else None
+                ready = wait([w.conn for w in busy] + [w.process.sentinel for w in busy], wait_for)
+                for i, worker in enumerate(workers):
+                    if worker.task is None:
+                        continue
+                    died = worker.process.sentinel in ready
+                    if worker.conn in ready or worker.conn.poll():
+                        try:
+                            idx, (ok, result) = worker.conn.recv()
+                        except EOFError:
+                            died = True
+                        else:
+                            worker.task = None
+                            if ok:
+                                stats.completed += 1
+                                results[idx] = result
+                            else:
+                                stats.failed += 1
+                                failed(idx, f'Task {idx} failed:\n{result}', RuntimeError)
+                            continue
+                    if died:
+                        stats.failed += 1
+                        idx = worker.task
+                        worker.stop(kill=True)
+                        workers[i] = _Worker(func)
+                        stats.restarts += 1
+                        failed(idx, f'Worker died while running task {idx} (exit code {worker.process.exitcode})',
+                               RuntimeError)
+                    elif worker.deadline is not None and time.time() >= worker.deadline:
+                        stats.timed_out += 1
+                        idx = worker.task
+                        worker.stop(kill=True)
+                        workers[i] = _Worker(func)
+                        stats.restarts += 1
+                        failed(idx, f'Task {idx} timed out after {timeout} seconds', TimeoutError)
+
+            if ordered:
+                while next_yield in results:
+                    yield results.pop(next_yield)
+                    next_yield += 1
+            else:
+                for idx in list(results):
+                    yield results.pop(idx)
+
+            if log_every and time.time() - last_log >= log_every:
+                logging.warning(str(stats))
+                last_log = time.time()
+    finally:
+        for worker in workers:
+            worker.stop(kill=worker.task is not None)
+
+
 def apply_parallel(func: Callable,
                    data: List[Any],
-                   cpu_cores: int = None) -> List[Any]:
+                   cpu_cores: int = None,
+                   chunk_size: int = None,
+                   timeout: float = None) -> List[Any]:
     """
     Apply function to list of elements.
-    Automatically determines the chunk size.
+    Automatically determines the chunk size: small chunks, so that a slow chunk does not
+    hold up a whole core, see `parallel_imap`.
     """
     if not cpu_cores:
         cpu_cores = cpu_count()
+    if not chunk_size:
+        chunk_size = max(ceil(len(data) / (cpu_cores * 16)), 1)
 
-    try:
-        chunk_size = ceil(len(data) / cpu_cores)
-        pool = Pool(cpu_cores)
-        transformed_data = pool.map(func, chunked(data, chunk_size), chunksize=1)
-    finally:
-        pool.close()
-        pool.join()
-        return transformed_data
+    return list(parallel_imap(func, chunked(data, chunk_size), processes=cpu_cores, timeout=timeout))
 
 
 def flattenlist(listoflists: List[List[Any]]):
@@ -142,20 +510,172 @@ def get_step2_prerequisite_files(output_directory):
         wget.download(url, out=str(outpath.absolute()))
 
 
-def create_nmslib_search_index(numpy_vectors):
+def vectors_checksum(numpy_vectors: np.ndarray, chunk_rows: int = 100000) -> dict:
+    "Number, dimension and crc32 of a matrix of vectors (as float32), to check an index was built from it."
+    crc = 0
+    for start in range(0, len(numpy_vectors), chunk_rows):
+        chunk = np.ascontiguousarray(numpy_vectors[start:start + chunk_rows], dtype=np.float32)
+        crc = zlib.crc32(chunk.tobytes(), crc)
+    return {'n_vectors': int(numpy_vectors.shape[0]), 'dim': int(numpy_vectors.shape[1]), 'crc32': crc}
+
+
+def index_meta_file(fname: str) -> Path:
+    return Path(str(fname) + '.meta.json')
+
+
+def create_nmslib_search_index(numpy_vectors,
+                               M: int = 16,
+                               efConstruction: int = 200,
+                               post: int = 2,
+                               indexThreadQty: int = None,
+                               efSearch: int = None,
+                               save_path: str = None,
+                               print_progress: bool = True):
     """Create search index using nmslib.
 
     Parameters
     ==========
     numpy_vectors : numpy.array
         The matrix of vectors
+    M : int
+        Number of neighbors of each point in the HNSW graph: higher gives better recall for
+        more memory and a longer build.
+    efConstruction : int
+        Size of the candidate list while building: higher gives a better graph, built slower.
+    post : int
+        Amount of post-processing of the graph (0 to 2).
+    indexThreadQty : int
+        Number of threads building the index, defaults to the number of cpus.
+    efSearch : int
+        Size of the candidate list at query time: higher gives better recall, slower queries.
+        nmslib's default when not given.
+    save_path : str
+        Save the index to this file, and its parameters with a checksum of `numpy_vectors`
+        next to it (see `load_nmslib_search_index`).
 
     Returns
     =======
     nmslib object that has index of numpy_vectors
     """
-
+    if nmslib is None:
+        raise ImportError('nmslib is not installed, see search_index.py for the other backends')
+    index_params = {'M': M, 'efConstruction': efConstruction, 'post': post,
+                    'indexThreadQty': indexThreadQty or cpu_count()}
     search_index = nmslib.init(method='hnsw', space='cosinesimil')
     search_index.addDataPointBatch(numpy_vectors)
-    search_index.createIndex({'post': 2}, print_progress=True)
+    search_index.createIndex(index_params, print_progress=print_progress)
+    query_params = {'efSearch': efSearch} if efSearch else {}
+    if query_params:
+        search_index.setQueryTimeParams(query_params)
+
+    if save_path:
+        search_index.saveIndex(str(save_path))
+        meta = {'backend': 'nmslib', 'method': 'hnsw', 'space': 'cosinesimil', 'index_params': index_params,
+                'query_params': query_params, 'vectors': vectors_checksum(numpy_vectors)}
+        with open(index_meta_file(save_path), 'w') as f:
+            json.dump(meta, f, indent=2)
+        logging.warning(f'Saved search index to {save_path}')
     return search_index
+
+
+def load_nmslib_search_index(fname: str, numpy_vectors: np.ndarray = None, efSearch: int = None):
+    """
+    Load an index saved by `create_nmslib_search_index`, with the query time parameters it was
+    saved with (or `efSearch`). Given the vectors the index refers to, check that they are the
+    ones it was built from.
+    """
+    if nmslib is None:
+        raise ImportError('nmslib is not installed, see search_index.py for the other backends')
+    with open(index_meta_file(fname)) as f:
+        meta = json.load(f)
+    if numpy_vectors is not None:
+        checksum = vectors_checksum(numpy_vectors)
+        assert checksum == meta['vectors'], f'{fname} was built from other vectors: {meta["vectors"]} != {checksum}'
+    search_index = nmslib.init(method=meta['method'], space=meta['space'])
+    search_index.loadIndex(str(fname))
+    query_params = dict(meta['query_params'], **({'efSearch': efSearch} if efSearch else {}))
+    if query_params:
+        search_index.setQueryTimeParams(query_params)
+    return search_index
+
+
+def exact_knn(numpy_vectors: np.ndarray, queries: np.ndarray, k: int = 10,
+              block_size: int = 100000, normalized: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Exact nearest neighbors by cosine distance, computed a block of vectors at a time
+    (`normalized` if both the vectors and the queries already have unit norm).
+
+    Returns
+    =======
+    ([n_queries x k] indices, [n_queries x k] cosine distances), nearest first
+    """
+    if not normalized:
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    best_idx = np.empty((len(queries), 0), dtype=np.int64)
+    best_sim = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(numpy_vectors), block_size):
+        block = np.asarray(numpy_vectors[start:start + block_size], dtype=np.float32)
+        if not normalized:
+            block = block / np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)
+        sim = np.hstack([best_sim, queries.astype(np.float32) @ block.T])
+        idx = np.hstack([best_idx, np.broadcast_to(np.arange(start, start + len(block)), (len(queries), len(block)))])
+        top = np.argpartition(-sim, min(k, sim.shape[1]) - 1, axis=1)[:, :k]
+        best_sim, best_idx = np.take_along_axis(sim, top, 1), np.take_along_axis(idx, top, 1)
+    order = np.argsort(-best_sim, axis=1, kind='stable')
+    return np.take_along_axis(best_idx, order, 1), 1. - np.take_along_axis(best_sim, order, 1)
+
+
+def _rss_bytes() -> int:
+    "Resident memory of this process (linux only, None elsewhere)."
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * mmap.PAGESIZE
+    except OSError:
+        return None
+
+
+def sweep_nmslib_params(numpy_vectors: np.ndarray,
+                        grid: List[dict],
+                        queries: np.ndarray = None,
+                        n_queries: int = 1000,
+                        efSearch: Sequence[int] = (10, 50, 100, 400),
+                        k: int = 10,
+                        seed: int = 0) -> List[dict]:
+    """
+    Build an index for every set of parameters of `grid` (keyword arguments of
+    `create_nmslib_search_index`, e.g. `[{'M': 16}, {'M': 32, 'efConstruction': 400}]`) and
+    measure, against `exact_knn`, its recall@k for every `efSearch`, with its build time, memory
+    and query latency.
+
+    Parameters
+    ==========
+    queries : np.ndarray
+        Query vectors, by default `n_queries` vectors sampled from `numpy_vectors` (which are
+        then their own nearest neighbor, in the exact and approximate results alike).
+
+    Returns
+    =======
+    One dict of parameters and measures per (grid entry, efSearch)
+    """
+    if queries is None:
+        rng = np.random.RandomState(seed)
+        queries = numpy_vectors[rng.choice(len(numpy_vectors), min(n_queries, len(numpy_vectors)), replace=False)]
+    exact, _ = exact_knn(numpy_vectors, queries, k)
+    results = []
+    for params in grid:
+        rss = _rss_bytes()
+        start = time.perf_counter()
+        search_index = create_nmslib_search_index(numpy_vectors, print_progress=False, **params)
+        build_s = time.perf_counter() - start
+        memory = _rss_bytes() - rss if rss is not None else None
+        for ef in efSearch:
+            search_index.setQueryTimeParams({'efSearch': ef})
+            start = time.perf_counter()
+            found = [search_index.knnQuery(q, k=k)[0] for q in queries]
+            query_ms = (time.perf_counter() - start) / len(queries) * 1000.
+            recall = np.mean([len(set(f) & set(e)) / k for f, e in zip(found, exact)])
+            results.append(dict(params, efSearch=ef, recall=float(recall), build_s=build_s,
+                                memory_bytes=memory, query_ms=query_ms))
+            logging.warning(json.dumps(results[-1]))
+        del search_index
+    return results
@@ -1,13 +1,23 @@
+import json
 import logging
+import threading
+import zlib
+from itertools import repeat
 from pathlib import Path
-from typing import List, Any
+from typing import List, Any, Callable, Iterable, Iterator, Sequence, Tuple
 
 import en_core_web_sm
 from fastai.text import *
-from keras.preprocessing.sequence import pad_sequences
+from more_itertools import chunked
 from tqdm import tqdm_notebook
 
-# from general_utils import apply_parallel, flattenlist
+from docstring_tokenizer import fast_tokenize_docstring
+from general_utils import parallel_imap
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+# token stream files: this magic, the number of tokens as uint64, then the int32 token ids
+TOKEN_STREAM_MAGIC = b'LMTOKS32'
+TOKEN_STREAM_HEADER = len(TOKEN_STREAM_MAGIC) + 8
 EN = en_core_web_sm.load()
 
 
@@ -21,6 +31,92 @@ def _dd():
     return 1
 
 
+def _imap(func: Callable, chunks: Iterable[Any], processes: int = None) -> Iterator[Any]:
+    "`map` in this process when `processes` is 1, ordered `parallel_imap` otherwise."
+    if processes == 1:
+        return map(func, chunks)
+    return parallel_imap(func, chunks, processes=processes)
+
+
+def token_hashes(tokens: List[str]) -> np.ndarray:
+    "32 bit hashes of tokens, the same in every process."
+    return np.fromiter((zlib.crc32(t.encode('utf-8', errors='replace')) for t in tokens),
+                       dtype=np.uint64, count=len(tokens))
+
+
+class CountMinSketch:
+    """
+    Token counts in fixed memory. Counts are never underestimated, and overestimated by at most
+    e * total / width with probability 1 - exp(-depth).
+    """
+    def __init__(self, width: int = 1 << 22, depth: int = 4, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, 1 << 31, size=depth).astype(np.uint64)
+        self.b = rng.randint(0, 1 << 31, size=depth).astype(np.uint64)
+        self.width = width
+        self.table = np.zeros((depth, width), dtype=np.int64)
+
+    def _columns(self, hashes: np.ndarray) -> np.ndarray:
+        return ((np.outer(self.a, hashes) + self.b[:, None]) % MERSENNE_PRIME) % np.uint64(self.width)
+
+    def add(self, hashes: np.ndarray, counts: np.ndarray) -> None:
+        columns = self._columns(hashes)
+        for row in range(len(self.a)):
+            np.add.at(self.table[row], columns[row], counts)
+
+    def estimate(self, tokens: List[str]) -> np.ndarray:
+        columns = self._columns(token_hashes(tokens))
+        return self.table[np.arange(len(self.a))[:, None], columns].min(axis=0)
+
+
+def _count_tokens(docs: List[str],
+                  bos_token: str,
+                  sketch: CountMinSketch = None,
+                  min_freq: int = 0) -> Counter:
+    """
+    Token counts of a chunk of documents, in order of first occurrence. With a `sketch`, only the
+    tokens it estimates to occur more than `min_freq` times are kept.
+    """
+    freq = Counter()
+    for x in docs:
+        freq.update((bos_token + ' ' + x).split())
+    if sketch is not None:
+        tokens = list(freq)
+        keep = sketch.estimate(tokens) > min_freq
+        freq = Counter({t: freq[t] for t, k in zip(tokens, keep) if k})
+    return freq
+
+
+def _numericalize(docs: List[str], stoi: dict, bos_token: str, max_seq_len: int):
+    "Token ids of a chunk of documents (prefixed by the bos token), concatenated, and their lengths."
+    tokens, lengths = [], np.empty(len(docs), dtype=np.int64)
+    for i, sent in enumerate(docs):
+        sent_tokens = sent.split()[:max_seq_len]
+        tokens.append(bos_token)
+        tokens.extend(sent_tokens)
+        lengths[i] = len(sent_tokens) + 1
+    # unknown tokens are 1, like with the `stoi` defaultdict, without adding them to it
+    ids = np.fromiter(map(stoi.get, tokens, repeat(1)), dtype=np.int32, count=len(tokens))
+    return ids, lengths
+
+
+def _hash_counts(docs: List[str], bos_token: str):
+    "Token hashes of a chunk of documents and their counts, for `CountMinSketch.add`."
+    freq = _count_tokens(docs, bos_token)
+    return token_hashes(list(freq)), np.fromiter(freq.values(), dtype=np.int64, count=len(freq))
+
+
+def load_token_stream(fname: str) -> np.ndarray:
+    "Memory map the token ids written by `lm_vocab.transform_flattened(..., destination_file=fname)`."
+    with open(fname, 'rb') as f:
+        header = f.read(TOKEN_STREAM_HEADER)
+    assert header[:len(TOKEN_STREAM_MAGIC)] == TOKEN_STREAM_MAGIC, f'{fname} is not a token stream file'
+    n_tokens = int(np.frombuffer(header[len(TOKEN_STREAM_MAGIC):], dtype='<u8')[0])
+    if n_tokens == 0:
+        return np.empty(0, dtype='<i4')
+    return np.memmap(fname, dtype='<i4', mode='r', offset=TOKEN_STREAM_HEADER, shape=(n_tokens,))
+
+
 def load_lm_vocab(lm_vocab_file: str):
     """load vm_vocab object."""
     with open(lm_vocab_file, 'rb') as f:
@@ -60,12 +156,44 @@ class lm_vocab:
         self.min_freq = min_freq
         self.bos_token = bos_token
 
-    def fit(self, data: List) -> None:
-        "Fit vocabulary to a list of documents."
+    def fit(self,
+            data: List,
+            processes: int = None,
+            chunk_size: int = 100000,
+            sketch_width: int = None) -> None:
+        """
+        Fit vocabulary to a list of documents.
+
+        Tokens are counted by chunks of documents in worker processes and the counts merged, so
+        memory grows with the number of distinct tokens instead of the total number of tokens.
+        The vocabulary is the same as with a single `Counter` over all the tokens (whose
+        `most_common` breaks ties by first occurrence, which merging in order preserves).
+
+        Parameters
+        ==========
+        data : List
+            List of documents, read twice when `sketch_width` is given.
+        processes : int
+            Number of worker processes, defaults to the number of cpus; 1 counts in this process.
+        chunk_size : int
+            Number of documents per task.
+        sketch_width : int
+            Count the tokens with a `CountMinSketch` of this width first, so that only the tokens
+            that may occur more than `min_freq` times are counted exactly. For corpora with too
+            many distinct (mostly rare) tokens to count them all.
+        """
         logging.warning(f'Processing {len(data):,} rows')
         # build vocab
-        trn = list_flatten([(self.bos_token + ' ' + x).split() for x in data])
-        freq = Counter(trn)
+        sketch = None
+        if sketch_width:
+            sketch = CountMinSketch(sketch_width)
+            for hashes, counts in _imap(partial(_hash_counts, bos_token=self.bos_token),
+                                        chunked(data, chunk_size), processes):
+                sketch.add(hashes, counts)
+        freq = Counter()
+        count_tokens = partial(_count_tokens, bos_token=self.bos_token, sketch=sketch, min_freq=self.min_freq)
+        for chunk_freq in _imap(count_tokens, chunked(data, chunk_size), processes):
+            freq.update(chunk_freq)
         itos = [o for o, c in freq.most_common(self.max_vocab) if c > self.min_freq]
 
         # insert placeholder tokens
@@ -81,8 +209,18 @@ class lm_vocab:
         self.itos = dict(enumerate(itos))
         self.stoi = stoi
 
-    def transform_flattened(self, data: List[str], dedup:bool = True) -> List[int]:
-        """Tokenizes, indexes and flattens list of strings for fastai language model."""
+    def transform_flattened(self,
+                            data: List[str],
+                            dedup: bool = True,
+                            destination_file: str = None,
+                            processes: int = 1,
+                            chunk_size: int = 100000) -> np.ndarray:
+        """
+        Tokenizes, indexes and flattens list of strings for fastai language model.
+
+        With a `destination_file`, the int32 ids are written to it chunk by chunk and returned
+        memory mapped (see `load_token_stream`), so that they never have to fit in memory.
+        """
         n = len(data)
         logging.warning(f'Transforming {n:,} rows.')
         if dedup:
@@ -90,37 +228,82 @@ class lm_vocab:
             n2 = len(data)
             logging.warning(f'Removed {n-n2:,} duplicate rows.')
 
-        tok_trn = list_flatten([(self.bos_token + ' ' + x).split() for x in data])
-        return np.array([self.stoi[s] for s in tok_trn])
-
-    def fit_transform_flattened(self, data: List[str]) -> List[int]:
+        numericalize = partial(_numericalize, stoi=self.stoi, bos_token=self.bos_token, max_seq_len=None)
+        chunks = _imap(numericalize, chunked(data, chunk_size), processes)
+        if destination_file is None:
+            return np.concatenate([ids for ids, _ in chunks] or [np.empty(0, dtype=np.int32)])
+
+        n_tokens = 0
+        with open(destination_file, 'wb') as f:
+            f.write(TOKEN_STREAM_MAGIC + np.array([0], dtype='<u8').tobytes())
+            for ids, _ in chunks:
+                f.write(ids.astype('<i4', copy=False).tobytes())
+                n_tokens += len(ids)
+            f.seek(len(TOKEN_STREAM_MAGIC))
+            f.write(np.array([n_tokens], dtype='<u8').tobytes())
+        logging.warning(f'Wrote {n_tokens:,} tokens to {destination_file}')
+        return load_token_stream(destination_file)
+
+    def fit_transform_flattened(self, data: List[str], destination_file: str = None) -> np.ndarray:
         "Applies `fit` then `transform_flattened` methods sequentially."
         self.fit(data)
-        return self.transform_flattened(data)
+        return self.transform_flattened(data, destination_file=destination_file)
 
     def transform(self,
-                 data: List[str],
-                 padding: bool = True,
-                 max_seq_len: int = 60) -> List[List[int]]:
+                  data: List[str],
+                  padding: bool = True,
+                  max_seq_len: int = 60,
+                  ragged: bool = False,
+                  processes: int = 1,
+                  chunk_size: int = 100000):
         """Tokenizes, and indexes list of strings without flattening.
 
         Parameters
         ==========
         data : List[str]
             List of documents (sentences) that you want to transform.
+        padding : bool
+            Return an int32 [n_rows x longest sequence] array, post-padded with zeros, otherwise
+            a list of int32 arrays.
         max_seq_len : int
             The maximum length of any sequence allowed.  Sequences will be truncated
-            and pre-padded to this length.
+            to this length, plus the bos token.  None to not truncate them.
+        ragged : bool
+            Return the ids of all the sequences concatenated and the offsets of each sequence in
+            them (`ids[offsets[i]:offsets[i + 1]]` is the i-th one) instead.
+        processes : int
+            Number of worker processes for large inputs, 1 (default) indexes in this process.
+        chunk_size : int
+            Number of documents per task.
         """
         logging.warning(f'Processing {len(data):,} rows')
-        idx_docs = [[self.stoi[self.bos_token]] + [self.stoi[word] for word in sent.split()[:max_seq_len]] for sent in data]
-        # default keras pad_sequences pre-pads to max length with zero
-        if padding:
+        numericalize = partial(_numericalize, stoi=self.stoi, bos_token=self.bos_token, max_seq_len=max_seq_len)
+        chunks = _imap(numericalize, chunked(data, chunk_size), processes)
+        if padding and not ragged:
             # because padding currently wrecks hidden state of lang model, so
             # by putting padding after (post) sequence we can just ignore the padding hidden states.
-            return pad_sequences(idx_docs, padding='post')
-        elif not padding:
-            return idx_docs
+            if max_seq_len is None:
+                # the longest sequence is only known once every document is indexed
+                chunks = list(chunks)
+                max_width = max([lengths.max(initial=0) for _, lengths in chunks], default=0)
+            else:
+                max_width = max_seq_len + 1
+            arr = np.zeros((len(data), max_width), dtype=np.int32)
+            start, width = 0, 0
+            for ids, lengths in chunks:
+                rows = arr[start:start + len(lengths)]
+                rows[np.arange(max_width) < lengths[:, None]] = ids
+                start += len(lengths)
+                width = max(width, lengths.max(initial=0))
+            # like keras' pad_sequences, pad to the longest sequence rather than to max_seq_len + 1
+            return arr[:, :width]
+
+        chunks = list(chunks)
+        ids = np.concatenate([ids for ids, _ in chunks] or [np.empty(0, dtype=np.int32)])
+        offsets = np.concatenate([[0]] + [lengths for _, lengths in chunks]).cumsum()
+        if ragged:
+            return ids, offsets
+        return [ids[offsets[i]:offsets[i + 1]] for i in range(len(data))]
 
     def save(self, destination_file: str) -> None:
         dest = Path(destination_file)
@@ -135,6 +318,23 @@ class lm_vocab:
 
 
 
+class MemmapLanguageModelLoader(LanguageModelLoader):
+    """
+    `LanguageModelLoader` over a (memory mapped) array of token ids, e.g. from `load_token_stream`:
+    the [bptt x bs] batches are views of it, only copied (and widened to int64) one at a time.
+    """
+    def batchify(self, data):
+        nb = data.shape[0] // self.bs
+        data = data[:nb*self.bs].reshape(self.bs, -1).T
+        if self.backwards: data=data[::-1]
+        return data
+
+    def get_batch(self, i, seq_len):
+        source = self.data
+        seq_len = min(seq_len, len(source) - 1 - i)
+        return T(source[i:i+seq_len]), T(np.ascontiguousarray(source[i+1:i+1+seq_len]).reshape(-1))
+
+
 def train_lang_model(model_path: int,
                      trn_indexed: List[int],
                      val_indexed: List[int],
@@ -157,7 +357,7 @@ def train_lang_model(model_path: int,
     model_path : str
         Path where you want to save model artifacts.
     trn_indexed : List[int]
-        flattened training data indexed
+        flattened training data indexed, or a token stream from `load_token_stream`
     val_indexed : List[int]
         flattened validation data indexed
     vocab_size : int
@@ -187,9 +387,10 @@ def train_lang_model(model_path: int,
     mpath = Path(model_path)
     mpath.mkdir(exist_ok=True)
 
-    # create data loaders
-    trn_dl = LanguageModelLoader(trn_indexed, bs, bptt)
-    val_dl = LanguageModelLoader(val_indexed, bs, bptt)
+    # create data loaders, memory mapped token streams are only copied a batch at a time
+    loader = MemmapLanguageModelLoader if isinstance(trn_indexed, np.memmap) else LanguageModelLoader
+    trn_dl = loader(trn_indexed, bs, bptt)
+    val_dl = loader(val_indexed, bs, bptt)
 
     # create lang model data
     md = LanguageModelData(mpath, 1, vocab_size, trn_dl, val_dl, bs=bs, bptt=bptt)
@@ -249,15 +450,58 @@ def make_prediction_from_list(model, l):
     return hidden_states.mean(0), hidden_states.max(0)[0], hidden_states[-1]
 
 
-def get_embeddings(lm_model, list_list_int):
+def pad_batch(seqs: Sequence[Sequence[int]]) -> Tuple[np.ndarray, np.ndarray]:
+    "[max length x batch] array of post-padded sequences (the layout of the language model input), and their lengths."
+    lengths = np.array([len(seq) for seq in seqs])
+    arr = np.zeros((lengths.max(), len(seqs)), dtype=np.int64)
+    for i, seq in enumerate(seqs):
+        arr[:lengths[i], i] = seq
+    return arr, lengths
+
+
+def masked_pooling(hidden_states: np.ndarray, lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Average-pooling, max-pooling and last time step of [seq_len x batch x n_dim] hidden states of
+    post-padded sequences, over the `lengths` first time steps of each one only. The language model
+    is unidirectional, so those time steps are the same as without padding.
+    """
+    valid = (np.arange(hidden_states.shape[0])[:, None] < lengths[None, :])[:, :, None]
+    avg_ = (hidden_states * valid).sum(0) / lengths[:, None]
+    max_ = np.where(valid, hidden_states, -np.inf).max(0)
+    last_ = hidden_states[lengths - 1, np.arange(len(lengths))]
+    return avg_, max_, last_
+
+
+def encode_batch(lm_model, seqs: Sequence[Sequence[int]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    "`make_prediction_from_list` for a batch of sequences at once, as float32 arrays."
+    arr, lengths = pad_batch(seqs)
+    lm_model.reset()  # language model is stateful, so you must reset upon each prediction
+    hidden_states = lm_model(V(arr).cpu())[-1][-1]  # last layer output, [seq_len x batch x n_dim]
+    return masked_pooling(hidden_states.data.numpy().astype(np.float32), lengths)
+
+
+def get_embeddings(lm_model,
+                   list_list_int,
+                   batch_size: int = 128,
+                   output_files: Tuple[str, str, str] = None,
+                   checkpoint_every: int = 100):
     """
     Vectorize a list of sequences List[List[int]] using a fast.ai language model.
 
+    Sequences are sorted by length and encoded `batch_size` at a time, so that batches need
+    little padding, which the pooling ignores (see `masked_pooling`).
+
     Paramters
     ---------
     lm_model : fastai language model
     list_list_int : List[List[int]]
         A list of sequences to encode
+    batch_size : int
+        Number of sequences per forward pass.
+    output_files : Tuple[str, str, str]
+        .npy files to write the average-pooling, max-pooling and last time step to, memory mapped.
+        Progress is checkpointed every `checkpoint_every` batches, and an interrupted run with
+        the same files, data and batch size resumes from the last checkpoint.
 
     Returns
     -------
@@ -265,17 +509,45 @@ def get_embeddings(lm_model, list_list_int):
         A tuple that returns the average-pooling, max-pooling over time steps as well as the last time step.
     """
     n_rows = len(list_list_int)
-    n_dim = lm_model[0].nhid
-    avgarr = np.empty((n_rows, n_dim))
-    maxarr = np.empty((n_rows, n_dim))
-    lastarr = np.empty((n_rows, n_dim))
-
-    for i in tqdm_notebook(range(len(list_list_int))):
-        avg_, max_, last_ = make_prediction_from_list(lm_model, list_list_int[i])
-        avgarr[i,:] = avg_.data.numpy()
-        maxarr[i,:] = max_.data.numpy()
-        lastarr[i,:] = last_.data.numpy()
-
+    n_dim = lm_model[0].emb_sz  # size of the last layer
+    lengths = np.array([len(seq) for seq in list_list_int])
+    order = np.argsort(-lengths, kind='stable')
+    n_batches = (n_rows + batch_size - 1) // batch_size
+
+    progress = {'n_rows': n_rows, 'batch_size': batch_size, 'done': 0}
+    if output_files is None:
+        arrs = [np.empty((n_rows, n_dim), dtype=np.float32) for _ in range(3)]
+    else:
+        progress_file = Path(output_files[0]).with_suffix('.progress.json')
+        if progress_file.exists() and all(Path(f).exists() for f in output_files):
+            with open(progress_file) as f:
+                saved = json.load(f)
+            if saved['n_rows'] == n_rows and saved['batch_size'] == batch_size:
+                progress = saved
+                logging.warning(f'Resuming after {progress["done"]:,} of {n_batches:,} batches')
+        mode = 'r+' if progress['done'] else 'w+'
+        arrs = [np.lib.format.open_memmap(f, mode=mode, dtype=np.float32, shape=(n_rows, n_dim))
+                for f in output_files]
+
+    def checkpoint(done):
+        if output_files is None:
+            return
+        for arr in arrs:
+            arr.flush()
+        progress['done'] = done
+        with open(progress_file, 'w') as f:
+            json.dump(progress, f)
+
+    for b in tqdm_notebook(range(progress['done'], n_batches)):
+        idx = order[b * batch_size:(b + 1) * batch_size]
+        pooled = encode_batch(lm_model, [list_list_int[i] for i in idx])
+        for arr, pool in zip(arrs, pooled):
+            arr[idx] = pool
+        if (b + 1) % checkpoint_every == 0:
+            checkpoint(b + 1)
+    checkpoint(n_batches)
+
+    avgarr, maxarr, lastarr = arrs
     return avgarr, maxarr, lastarr
 
 
@@ -287,34 +559,69 @@ def tokenize_docstring(text):
 
 class Query2Emb:
     "Assists in turning natural language phrases into sentence embeddings from a language model."
-    def __init__(self, lang_model, vocab):
+    poolings = ('mean', 'max', 'last')
+
+    def __init__(self, lang_model, vocab, batch_size: int = 64):
         self.lang_model = lang_model
         self.lang_model.eval()
         self.lang_model.reset()
         self.vocab = vocab
         self.stoi = vocab.stoi
+        self.batch_size = batch_size
+        # the language model is stateful, so only one forward pass can run at a time
+        self.lock = threading.Lock()
         self.ndim = self._str2emb('This is test to get the dimensionality.').shape[-1]
 
     def _str2arr(self, str_inp):
-        raw_str = ' '.join(tokenize_docstring(str_inp))
+        raw_str = ' '.join(fast_tokenize_docstring(str_inp))
         raw_arr = self.vocab.transform([raw_str])[0]
         arr = np.expand_dims(np.array(raw_arr), -1)
         return V(T(arr))
 
     def _str2emb(self, str_inp):
         v_arr = self._str2arr(str_inp).cpu()
-        self.lang_model.reset()
-        hidden_states = self.lang_model(v_arr)[-1][-1]
+        with self.lock:
+            self.lang_model.reset()
+            hidden_states = self.lang_model(v_arr)[-1][-1]
         return hidden_states
 
+    def embed_all(self, texts: List[str]) -> dict:
+        """
+        Every pooling of the embeddings of a list of strings, from a single forward pass per
+        `batch_size` strings: {'mean': [n x ndim], 'max': [n x ndim], 'last': [n x ndim]}.
+        """
+        seqs = self.vocab.transform([' '.join(fast_tokenize_docstring(t)) for t in texts], padding=False)
+        pooled = {pooling: np.empty((len(seqs), self.ndim), dtype=np.float32) for pooling in self.poolings}
+        # batches of similar lengths need little padding
+        order = np.argsort([-len(seq) for seq in seqs], kind='stable')
+        for start in range(0, len(seqs), self.batch_size):
+            idx = order[start:start + self.batch_size]
+            with self.lock:
+                batch_pooled = encode_batch(self.lang_model, [seqs[i] for i in idx])
+            for pooling, arr in zip(self.poolings, batch_pooled):
+                pooled[pooling][idx] = arr
+        return pooled
+
+    def embed_batch(self, texts: List[str], pooling: str = 'mean') -> np.ndarray:
+        """
+        [n x ndim] embeddings of a list of strings (one padded and masked forward pass per
+        `batch_size` strings), `pooling` being 'mean', 'max', 'last' or 'cat' (the three
+        concatenated, [n x 3 * ndim]).
+        """
+        assert pooling in self.poolings + ('cat',), f'Unknown pooling {pooling}'
+        pooled = self.embed_all(texts)
+        if pooling == 'cat':
+            return np.concatenate([pooled[p] for p in self.poolings], axis=1)
+        return pooled[pooling]
+
     def emb_mean(self, str_inp):
-        return self._str2emb(str_inp).mean(0).data.numpy()
+        return self.embed_batch([str_inp], 'mean')
 
     def emb_max(self, str_inp):
-        return self._str2emb(str_inp).max(0)[0].data.numpy()
+        return self.embed_batch([str_inp], 'max')
 
     def emb_last(self, str_inp):
-        return self._str2emb(str_inp)[-1].data.numpy()
+        return self.embed_batch([str_inp], 'last')
 
     def emb_cat(self, str_inp):
-        return np.concatenate([self.emb_mean(str_inp), self.emb_max(str_inp), self.emb_last(str_inp)], axis=1)
+        return self.embed_batch([str_inp], 'cat')
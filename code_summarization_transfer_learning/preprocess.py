@@ -0,0 +1,461 @@
+"""
+Streaming version of "1 - Preprocess Data.ipynb".
+
+Reads the raw GitHub csv dumps in bounded chunks, extracts (function, docstring) pairs in worker
+processes and writes one row per function to parquet shards, so peak memory depends on the
+chunk and shard sizes, not on the size of the corpus.
+
+Every shard has a manifest of the (nwo, path, content hash) of the files it was built from, and
+every repository is assigned to a split by a hash of its name, so running again on a newer dump
+only processes new or changed files, appends them as new shards and never moves a repository
+from one split to another.
+
+    python preprocess.py --output ./data/processed_shards
+"""
+import argparse
+import hashlib
+import json
+import logging
+import pickle
+import sqlite3
+import zlib
+from collections import deque
+from multiprocessing import cpu_count
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import pandas as pd
+from more_itertools import chunked
+
+from feature_extractor import get_function_docstring_pairs_fast
+from general_utils import parallel_imap, ParallelStats
+from processed_table import write_processed_table
+
+RAW_DATA_URLS = [f'https://storage.googleapis.com/kubeflow-examples/code_search/raw_data/00000000000{i}.csv'
+                 for i in range(10)]
+
+COLUMNS = ['nwo', 'path', 'function_name', 'lineno', 'original_function', 'function_tokens',
+           'docstring_tokens', 'api_sequence', 'tokenized_function_name', 'url', 'split']
+
+# list of the shards clustered by dedup.py, removed when shards are appended
+CLUSTERS_FILE = 'CLUSTERS.json'
+
+# bump when the output of get_function_docstring_pairs_fast changes, to invalidate the cache and
+# the datasets built with another version (see dataset_params)
+# 2: function tokens keep literals as written and api sequences leave out the docstring, unlike
+#    the astor extractor of the notebook (see get_function_docstring_pairs_fast)
+EXTRACTOR_VERSION = 2
+
+
+def read_raw_files(csv_files: List[str], chunksize: int = 10000) -> Iterator[Tuple[str, str, str]]:
+    """Stream (nwo, path, content) for every file of the raw csv dumps."""
+    for fname in csv_files:
+        logging.warning(f'Reading {fname}')
+        for chunk in pd.read_csv(fname, chunksize=chunksize):
+            repo_path = chunk['repo_path'].str.split(n=1)
+            yield from zip(repo_path.str[0], repo_path.str[1], chunk['content'])
+
+
+def content_hash(content: str) -> bytes:
+    return hashlib.blake2b(content.encode('utf-8', errors='replace'), digest_size=16).digest()
+
+
+def extract_pairs(task: Tuple[list, list]) -> Tuple[list, dict]:
+    """
+    Worker side of `preprocess`: a task is a list of (nwo, path, content hash) entries and the
+    (content hash, content) of the files that are not cached yet; only those are parsed.
+    """
+    entries, misses = task
+    return entries, {h: get_function_docstring_pairs_fast(content) for h, content in misses}
+
+
+def extract_separately(misses: List[Tuple[bytes, str]], processes: int = None, timeout: float = None) -> dict:
+    """
+    Pairs of the files of a task that failed or timed out, extracted one file per task so that
+    a file the extractor crashes or hangs on only loses itself. Failed files are left out.
+    """
+    if not misses:
+        return {}
+    extracted = {}
+    for result in parallel_imap(extract_pairs, (([], [miss]) for miss in misses),
+                                processes=min(processes or cpu_count(), len(misses)), timeout=timeout,
+                                errors='ignore', default=None):
+        if result is not None:
+            extracted.update(result[1])
+    return extracted
+
+
+def repo_split(nwo: str, train_size: float = 0.87, valid_size: float = 0., salt: str = '') -> str:
+    """
+    'train', 'valid' or 'test' for a repository, from a hash of its name: the assignment of a
+    repository does not depend on the other repositories, unlike `train_test_split`.
+    """
+    digest = hashlib.blake2b((salt + nwo).encode('utf-8', errors='replace'), digest_size=8).digest()
+    x = int.from_bytes(digest, 'big') / 2 ** 64
+    if x < train_size:
+        return 'train'
+    return 'valid' if x < train_size + valid_size else 'test'
+
+
+def make_rows(nwo: str, path: str, pairs: List[tuple], split: str) -> List[tuple]:
+    """One row per function (see `COLUMNS`) of a file."""
+    return [(nwo, path) + tuple(pair) + (f'https://github.com/{nwo}/blob/master/{path}#L{pair[1]}', split)
+            for pair in pairs]
+
+
+class ExtractionCache:
+    """
+    Extracted (function, docstring) pairs of source files in a sqlite database, keyed by a hash
+    of the file content, so that files unchanged between dumps, or copied across forks, are
+    only parsed once. Entries of another `version` of the extractor are ignored.
+    """
+
+    def __init__(self, path: str, version: int = EXTRACTOR_VERSION):
+        self.version = version
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS pairs '
+                        '(hash BLOB, version INTEGER, pairs BLOB, PRIMARY KEY (hash, version))')
+        self.hits = self.misses = 0
+
+    def _select(self, columns: str, hashes: List[bytes]):
+        hashes = list(hashes)
+        for i in range(0, len(hashes), 500):
+            batch = hashes[i:i + 500]
+            yield from self.db.execute(f'SELECT {columns} FROM pairs WHERE version = ? AND hash IN '
+                                       f'({",".join("?" * len(batch))})', [self.version] + batch)
+
+    def contains(self, hashes: List[bytes]) -> set:
+        found = {h for h, in self._select('hash', hashes)}
+        self.hits += len(found)
+        self.misses += len(set(hashes)) - len(found)
+        return found
+
+    def get_many(self, hashes: List[bytes]) -> dict:
+        return {h: pickle.loads(zlib.decompress(blob)) for h, blob in self._select('hash, pairs', hashes)}
+
+    def put_many(self, pairs: dict) -> None:
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO pairs VALUES (?, ?, ?)',
+                                [(h, self.version, zlib.compress(pickle.dumps(p), 1)) for h, p in pairs.items()])
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def function_key(row: tuple) -> bytes:
+    """Key of the exact duplicate check of the notebook: (original_function, function_tokens)."""
+    return hashlib.blake2b((row[4] + '\0' + row[5]).encode('utf-8', errors='replace'), digest_size=8).digest()
+
+
+def file_key(nwo: str, path: str) -> bytes:
+    return hashlib.blake2b(f'{nwo}\0{path}'.encode('utf-8', errors='replace'), digest_size=8).digest()
+
+
+class ShardWriter:
+    """
+    Buffer rows and write them as numbered parquet shards of about `rows_per_shard` rows, each
+    with a manifest of the files its rows come from. The rows of a file are never split over
+    two shards.
+    """
+
+    def __init__(self, output_dir: str, rows_per_shard: int = 200000, first_shard: int = 0):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.rows_per_shard = rows_per_shard
+        self.shard_id = first_shard
+        self.rows = []
+        self.files = []
+        self.shards = []
+
+    def add(self, rows: List[tuple], files: List[Tuple[str, str, bytes]]) -> None:
+        """Add the rows extracted from `files`, a list of (nwo, path, content hash)."""
+        self.rows.extend(rows)
+        self.files.extend(files)
+        if len(self.rows) >= self.rows_per_shard:
+            self._write()
+
+    def close(self) -> List[Path]:
+        if self.rows or self.files:
+            self._write()
+        return self.shards
+
+    def _write(self) -> None:
+        dest = self.output_dir / f'shard-{self.shard_id:05d}.parquet'
+        pd.DataFrame(self.rows, columns=COLUMNS).to_parquet(dest, index=False)
+        manifest = pd.DataFrame([(nwo, path, h.hex()) for nwo, path, h in self.files],
+                                columns=['nwo', 'path', 'content_hash'])
+        # the manifest is written last: a shard without one is incomplete and is ignored
+        manifest.to_parquet(manifest_file(dest), index=False)
+        logging.warning(f'Wrote {len(self.rows):,} rows of {len(self.files):,} files to {dest}')
+        self.shards.append(dest)
+        self.shard_id += 1
+        self.rows, self.files = [], []
+
+
+def manifest_file(shard: Path) -> Path:
+    return shard.with_name(shard.name.replace('shard-', 'manifest-'))
+
+
+def list_shards(shard_dir: str) -> List[Path]:
+    """Complete shards (with a manifest) of a directory, in order."""
+    return [shard for shard in sorted(Path(shard_dir).glob('shard-*.parquet')) if manifest_file(shard).exists()]
+
+
+def load_manifest(shard_dir: str) -> dict:
+    """(nwo, path) -> (content hash, shard index) of the latest version of every processed file."""
+    latest = {}
+    for i, shard in enumerate(list_shards(shard_dir)):
+        manifest = pd.read_parquet(manifest_file(shard))
+        for nwo, path, h in zip(manifest['nwo'], manifest['path'], manifest['content_hash']):
+            latest[(nwo, path)] = (h, i)
+    return latest
+
+
+def clusters_are_current(shard_dir: str) -> bool:
+    """Whether `dedup.py` clustered all the complete shards of a directory, since they were written."""
+    fname = Path(shard_dir) / CLUSTERS_FILE
+    if not fname.exists():
+        return False
+    with open(fname) as f:
+        clustered = json.load(f)['shards']
+    return clustered == [shard.name for shard in list_shards(shard_dir)]
+
+
+def dataset_params(output_dir: str, params: dict) -> dict:
+    """
+    Parameters the shards of `output_dir` were built with, saved on the first run: changing the
+    split sizes or the extractor on a later run would mix incompatible rows.
+    """
+    fname = Path(output_dir) / 'DATASET.json'
+    if fname.exists():
+        with open(fname) as f:
+            saved = json.load(f)
+        assert saved == params, f'{output_dir} was built with {saved}, got {params}'
+    else:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        with open(fname, 'w') as f:
+            json.dump(params, f, indent=2)
+    return params
+
+
+def preprocess(csv_files: List[str],
+               output_dir: str,
+               chunksize: int = 10000,
+               files_per_task: int = 20,
+               rows_per_shard: int = 200000,
+               processes: int = None,
+               timeout: float = 300,
+               dedup: bool = True,
+               cache_path: str = None,
+               train_size: float = 0.87,
+               valid_size: float = 0.) -> List[Path]:
+    """
+    Extract function rows from raw csv dumps into parquet shards of `output_dir`.
+
+    Files already processed into `output_dir` with the same content are skipped, changed files
+    are processed again and their new rows supersede the old ones (see `load_shards`).
+
+    Parameters
+    ==========
+    csv_files : List[str]
+        Paths or urls of the raw csv dumps (columns `repo_path` and `content`).
+    chunksize : int
+        Number of csv rows read at a time.
+    files_per_task : int
+        Number of source files sent to a worker process at a time.
+    rows_per_shard : int
+        Number of function rows per parquet shard.
+    processes : int
+        Number of worker processes, defaults to the number of cpus.
+    timeout : float
+        Seconds after which a task is abandoned and its worker replaced. The files of a failed
+        or abandoned task are extracted again one by one, the ones that fail again are left
+        out of the manifest so that the next run tries them again.
+    dedup : bool
+        Drop rows whose (original_function, function_tokens) was already written, like the
+        notebook's `drop_duplicates`. This keeps two 8 byte keys per unique function in memory.
+        Files whose content was already seen are skipped before being parsed.
+    cache_path : str
+        Sqlite database of the pairs extracted from each file content (see `ExtractionCache`),
+        only files missing from it are parsed. No cache by default.
+    train_size, valid_size : float
+        Share of the repositories in the train and valid splits, the others are in test (see
+        `repo_split`). They cannot change once `output_dir` has shards.
+
+    Returns
+    =======
+    List of the parquet shards written.
+    """
+    params = dataset_params(output_dir, {'train_size': train_size, 'valid_size': valid_size,
+                                         'extractor_version': EXTRACTOR_VERSION})
+    existing = list_shards(output_dir)
+    manifest = load_manifest(output_dir)
+    splits = {}
+    writer = ShardWriter(output_dir, rows_per_shard,
+                         first_shard=int(existing[-1].stem.split('-')[1]) + 1 if existing else 0)
+    cache = ExtractionCache(cache_path) if cache_path else None
+    stats = ParallelStats()
+    seen, seen_files = {}, set()  # function key -> file key of the previous run that has it
+    n_rows = n_duplicates = n_duplicate_files = n_unchanged = n_failed_files = 0
+    if dedup:
+        seen_files = {bytes.fromhex(h)[:8] for h, _ in manifest.values()}
+        for shard in existing:
+            functions = pd.read_parquet(shard, columns=['nwo', 'path', 'original_function', 'function_tokens'])
+            for row in zip(functions['nwo'], functions['path'], [None] * len(functions), [None] * len(functions),
+                           functions['original_function'], functions['function_tokens']):
+                seen[function_key(row)] = file_key(row[0], row[1])
+    if existing:
+        logging.warning(f'Found {len(existing)} shards of {len(manifest):,} files in {output_dir}')
+
+    submitted = deque()  # tasks whose results were not read yet, in order
+
+    def tasks():
+        nonlocal n_duplicate_files, n_unchanged
+        for files in chunked(read_raw_files(csv_files, chunksize), files_per_task):
+            entries, contents = [], {}
+            for nwo, path, content in files:
+                if not isinstance(content, str):
+                    continue
+                h = content_hash(content)
+                if manifest.get((nwo, path), (None,))[0] == h.hex():
+                    n_unchanged += 1
+                    continue
+                entries.append((nwo, path, h))
+                # still listed in the manifest, so that it supersedes an older version of the file;
+                # contents are only marked as seen once extracted (copies of a content being extracted
+                # are parsed again, their rows are then removed as duplicates)
+                if dedup and h[:8] in seen_files:
+                    n_duplicate_files += 1
+                    continue
+                contents[h] = content
+            cached = cache.contains(list(contents)) if cache else set()
+            task = (entries, [(h, content) for h, content in contents.items() if h not in cached])
+            submitted.append(task)
+            yield task
+
+    for result in parallel_imap(extract_pairs, tasks(), processes=processes, timeout=timeout,
+                                errors='ignore', default=None, stats=stats, log_every=60):
+        entries, misses = submitted.popleft()
+        if result is None:
+            logging.warning(f'Extracting the {len(misses)} files of the failed task one by one')
+            extracted = extract_separately(misses, processes, timeout)
+        else:
+            extracted = result[1]
+        failed = {h for h, _ in misses} - extracted.keys()
+        if failed:
+            # left out of the manifest, so that the next run tries them again
+            entries = [entry for entry in entries if entry[2] not in failed]
+            n_failed_files += len(failed)
+        if cache:
+            cache.put_many(extracted)
+            extracted.update(cache.get_many({h for _, _, h in entries} - extracted.keys()))
+        if dedup:
+            seen_files.update(h[:8] for h in extracted)
+        rows = []
+        for nwo, path, h in entries:
+            if nwo not in splits:
+                splits[nwo] = repo_split(nwo, params['train_size'], params['valid_size'])
+            rows.extend(make_rows(nwo, path, extracted.get(h, []), splits[nwo]))
+        if dedup:
+            unique = []
+            for row in rows:
+                key = function_key(row)
+                # functions of previous runs may come back in a new version of their own file
+                owner = seen.get(key)
+                if owner is None or owner == file_key(row[0], row[1]):
+                    seen[key] = b''
+                    unique.append(row)
+            n_duplicates += len(rows) - len(unique)
+            rows = unique
+        n_rows += len(rows)
+        writer.add(rows, entries)
+    shards = writer.close()
+    clusters_file = Path(output_dir) / CLUSTERS_FILE
+    if shards and clusters_file.exists():
+        clusters_file.unlink()
+        logging.warning('Appended shards to clustered shards, run dedup.py again to update their cluster ids')
+    logging.warning(f'Extraction tasks: {stats}')
+    if cache:
+        logging.warning(f'Extraction cache: {cache.hits:,} hits, {cache.misses:,} misses')
+        cache.close()
+    logging.warning(f'Wrote {n_rows:,} rows to {len(shards)} shards, removed {n_duplicates:,} duplicate rows, '
+                    f'skipped {n_duplicate_files:,} duplicate files and {n_unchanged:,} unchanged files, '
+                    f'failed to extract {n_failed_files:,} files')
+    return shards
+
+
+def load_shards(shard_dir: str,
+                columns: List[str] = None,
+                split: str = None,
+                latest_only: bool = True) -> pd.DataFrame:
+    """
+    Read parquet shards back into one dataframe, like `pd.read_pickle('dataframe_processed.pkl')`.
+
+    Parameters
+    ==========
+    columns : List[str]
+        Columns to read, all by default.
+    split : str
+        Only read the rows of this split ('train', 'valid' or 'test').
+    latest_only : bool
+        Drop the rows of files that were processed again, because they changed, into a later shard.
+    """
+    manifest = load_manifest(shard_dir) if latest_only else {}
+    dfs = []
+    for i, shard in enumerate(list_shards(shard_dir)):
+        read_columns = None if columns is None else list(dict.fromkeys(columns + ['nwo', 'path', 'split']))
+        df = pd.read_parquet(shard, columns=read_columns)
+        if split is not None:
+            df = df[df['split'] == split]
+        if latest_only:
+            latest = [manifest[(nwo, path)][1] == i for nwo, path in zip(df['nwo'], df['path'])]
+            df = df[latest]
+        dfs.append(df if columns is None else df[columns])
+    df = pd.concat(dfs, ignore_index=True)
+    if 'cluster_id' in df and not clusters_are_current(shard_dir):
+        logging.warning(f'The cluster ids of {shard_dir} are stale (shards were appended), run dedup.py again')
+    return df
+
+
+def shards_to_processed_table(shard_dir: str, path: str, n_buckets: int = 64) -> None:
+    """Write the rows of the shards (without the old versions of changed files) as a processed table."""
+    manifest = load_manifest(shard_dir)
+    for i, shard in enumerate(list_shards(shard_dir)):
+        df = pd.read_parquet(shard)
+        df = df[[manifest[(nwo, file_path)][1] == i for nwo, file_path in zip(df['nwo'], df['path'])]]
+        write_processed_table(df, path, n_buckets, part=i)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Extract function/docstring pairs from raw csv dumps into parquet shards')
+    parser.add_argument('--csv_files', nargs='+', default=RAW_DATA_URLS, help='Raw csv dumps (paths or urls)')
+    parser.add_argument('--output', required=True, help='Directory for the parquet shards')
+    parser.add_argument('--chunksize', type=int, default=10000, help='Csv rows read at a time')
+    parser.add_argument('--files_per_task', type=int, default=20, help='Source files per worker task')
+    parser.add_argument('--rows_per_shard', type=int, default=200000, help='Function rows per shard')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes, all cpus by default')
+    parser.add_argument('--timeout', type=float, default=300, help='Seconds before a worker task is abandoned')
+    parser.add_argument('--no_dedup', action='store_true', help='Keep exact duplicate functions')
+    parser.add_argument('--cache', help='Sqlite file caching the pairs extracted from each file content')
+    parser.add_argument('--train_size', type=float, default=0.87, help='Share of the repositories in train')
+    parser.add_argument('--valid_size', type=float, default=0., help='Share of the repositories in valid')
+    parser.add_argument('--table', help='Also write the shards as a processed table (see processed_table.py) here')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    preprocess(args.csv_files, args.output,
+               chunksize=args.chunksize,
+               files_per_task=args.files_per_task,
+               rows_per_shard=args.rows_per_shard,
+               processes=args.processes,
+               timeout=args.timeout,
+               dedup=not args.no_dedup,
+               cache_path=args.cache,
+               train_size=args.train_size,
+               valid_size=args.valid_size)
+    if args.table:
+        shards_to_processed_table(args.output, args.table)
@@ -0,0 +1,129 @@
+"""
+The processed function table (`dataframe_processed.pkl` of the first notebook) as a parquet
+dataset partitioned by a hash of the repository, so that readers load only the columns and
+rows they need:
+
+    df = load_processed_table('./data/processed_table', columns=['nwo', 'docstring_tokens'], min_docstring_len=3)
+
+Every row also has a `docstring_len` (number of docstring tokens, which the notebooks filter
+on) and a `row_id` (position in the original table, rows are loaded back in that order).
+"""
+import hashlib
+import json
+import logging
+import shutil
+from pathlib import Path
+from typing import List, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+TABLE_INFO = '_table.json'
+
+
+def nwo_bucket(nwo: str, n_buckets: int) -> int:
+    digest = hashlib.blake2b(nwo.encode('utf-8', errors='replace'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % n_buckets
+
+
+def docstring_len(docstring_tokens: pd.Series) -> pd.Series:
+    """Number of tokens of each docstring, like `df.docstring_tokens.str.split().apply(listlen)`."""
+    return docstring_tokens.str.split().str.len().fillna(0).astype('int32')
+
+
+def table_info(path: str) -> dict:
+    with open(Path(path) / TABLE_INFO) as f:
+        return json.load(f)
+
+
+def write_processed_table(df: pd.DataFrame, path: str, n_buckets: int = 64, part: int = 0) -> None:
+    """
+    Write (with `part=0`, replacing the table already in `path`) or append (with a new `part`
+    number) rows of the processed table.
+
+    Parameters
+    ==========
+    df : pd.DataFrame
+        Processed functions, with at least the `nwo` and `docstring_tokens` columns.
+    path : str
+        Directory of the partitioned dataset.
+    n_buckets : int
+        Number of repository partitions, fixed when the dataset is created.
+    part : int
+        Number of this part of the dataset; rows are given `row_id`s following the ones of the
+        parts already written. Part 0 starts a new table.
+    """
+    dest = Path(path)
+    info_file = dest / TABLE_INFO
+    if part == 0:
+        # rows of a previous table would otherwise stay in the partitions the new rows do not cover
+        for partition in dest.glob('nwo_bucket=*'):
+            shutil.rmtree(partition)
+        if info_file.exists():
+            info_file.unlink()
+    info = table_info(path) if info_file.exists() else {'n_buckets': n_buckets, 'n_rows': 0}
+    df = df.copy()
+    if 'row_id' not in df:
+        df['row_id'] = range(info['n_rows'], info['n_rows'] + len(df))
+    df['docstring_len'] = docstring_len(df['docstring_tokens'])
+    df['nwo_bucket'] = [nwo_bucket(nwo, info['n_buckets']) for nwo in df['nwo']]
+    partitioning = ds.partitioning(pa.schema([('nwo_bucket', pa.int32())]), flavor='hive')
+    ds.write_dataset(pa.Table.from_pandas(df, preserve_index=False), dest, format='parquet',
+                     partitioning=partitioning, basename_template=f'part-{part:05d}-{{i}}.parquet',
+                     existing_data_behavior='overwrite_or_ignore')
+    info['n_rows'] = max(info['n_rows'], int(df['row_id'].max()) + 1) if len(df) else info['n_rows']
+    with open(info_file, 'w') as f:
+        json.dump(info, f, indent=2)
+    logging.warning(f'Wrote {len(df):,} rows to {dest}')
+
+
+def load_processed_table(path: str,
+                         columns: List[str] = None,
+                         nwo: Union[str, List[str]] = None,
+                         min_docstring_len: int = None,
+                         max_docstring_len: int = None,
+                         split: str = None) -> pd.DataFrame:
+    """
+    Read part of the processed table, in the order of the original table.
+
+    Parameters
+    ==========
+    columns : List[str]
+        Columns to read, all by default.
+    nwo : str or List[str]
+        Only read the rows of these repositories; only their partitions are read.
+    min_docstring_len, max_docstring_len : int
+        Only read the rows with that many docstring tokens or more / or less, e.g.
+        `min_docstring_len=3` for the functions with a docstring of the notebooks and
+        `max_docstring_len=2` for the ones without.
+    split : str
+        Only read the rows of this split, for tables built from `preprocess.py` shards.
+    """
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    conditions = []
+    if nwo is not None:
+        nwos = [nwo] if isinstance(nwo, str) else list(nwo)
+        n_buckets = table_info(path)['n_buckets']
+        conditions.append(ds.field('nwo_bucket').isin(sorted({nwo_bucket(n, n_buckets) for n in nwos})))
+        conditions.append(ds.field('nwo').isin(nwos))
+    if min_docstring_len is not None:
+        conditions.append(ds.field('docstring_len') >= min_docstring_len)
+    if max_docstring_len is not None:
+        conditions.append(ds.field('docstring_len') <= max_docstring_len)
+    if split is not None:
+        conditions.append(ds.field('split') == split)
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+
+    read_columns = None
+    if columns is not None:
+        read_columns = list(dict.fromkeys(columns + ['row_id']))
+    df = dataset.to_table(columns=read_columns, filter=condition).to_pandas()
+    df = df.sort_values('row_id').reset_index(drop=True)
+    if columns is not None:
+        df = df[columns]
+    elif 'nwo_bucket' in df:
+        df = df.drop(columns=['nwo_bucket'])
+    return df
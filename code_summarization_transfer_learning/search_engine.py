@@ -0,0 +1,105 @@
+"""
+Semantic code search (the search engine of "5 - Build Search Index.ipynb"): a query is embedded
+with the language model (`lang_model_utils.Query2Emb`), its nearest code embeddings are looked up
+in a search index (nmslib or `search_index.py`), and the code and url of the results are read from
+a snippet store on disk, so that serving does not hold the code of the corpus in memory.
+
+    write_snippet_store('./data/search/snippets.jsonl', without_docstrings['original_function'], without_docstrings['url'])
+    se = SearchEngine(search_index, SnippetStore('./data/search/snippets.jsonl'), q2emb)
+    se.search('read data into pandas dataframe', k=5)
+"""
+import json
+import logging
+from typing import Iterable, List, NamedTuple
+
+from general_utils import LineIndexedFile
+
+
+class SearchResult(NamedTuple):
+    rank: int
+    idx: int  # row of the search index
+    distance: float  # cosine distance to the query
+    code: str
+    url: str
+
+
+def write_snippet_store(fname: str, codes: Iterable[str], urls: Iterable[str]) -> int:
+    """Write the code and url of each row of the search index as one json line, returns the number of rows."""
+    n = 0
+    with open(fname, 'w') as f:
+        for code, url in zip(codes, urls):
+            f.write(json.dumps({'code': code, 'url': url}) + '\n')
+            n += 1
+    logging.warning(f'Wrote {n:,} snippets to {fname}')
+    return n
+
+
+class SnippetStore:
+    """Code and url of the i-th row of the search index, read on demand from a `write_snippet_store` file."""
+
+    def __init__(self, fname: str):
+        self.lines = LineIndexedFile(fname, cache_index=True)
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def __getitem__(self, i: int) -> dict:
+        return json.loads(self.lines[i])
+
+
+class SearchEngine:
+    """Organizes all the necessary elements we need to make a search engine."""
+
+    def __init__(self, search_index, snippets: SnippetStore, query2emb, pooling: str = 'mean', num_threads: int = 0):
+        """
+        Parameters
+        ==========
+        search_index : nmslib object or search_index.SearchIndex
+            This is pre-computed search index.
+        snippets : SnippetStore
+            Code and url of each row of the search index.
+        query2emb : lang_model_utils.Query2Emb
+            Embeds queries in the same vector space as what is loaded into the search index.
+        pooling : str
+            Pooling of the query embeddings, see `Query2Emb.embed_batch`.
+        num_threads : int
+            Threads searching the index in `search_batch`, 0 for one per cpu.
+        """
+        self.search_index = search_index
+        self.snippets = snippets
+        self.query2emb = query2emb
+        self.pooling = pooling
+        self.num_threads = num_threads
+
+    def search_batch(self, queries: List[str], k: int = 5, num_threads: int = None) -> List[List[SearchResult]]:
+        """
+        The `k` nearest neighbors (by cosine distance) of each query: the queries are embedded in
+        one batch, and the index searched by `num_threads` threads (`self.num_threads` by default).
+        """
+        vectors = self.query2emb.embed_batch(queries, pooling=self.pooling)
+        num_threads = self.num_threads if num_threads is None else num_threads
+        neighbors = self.search_index.knnQueryBatch(vectors, k=k, num_threads=num_threads)
+        results = []
+        for idxs, dists in neighbors:
+            results.append([SearchResult(rank, int(idx), float(dist), **self.snippets[int(idx)])
+                            for rank, (idx, dist) in enumerate(zip(idxs, dists))])
+        return results
+
+    def search(self, query: str, k: int = 5) -> List[SearchResult]:
+        """
+        The `k` nearest neighbors of a query.
+
+        Parameters
+        ==========
+        query : str
+            a search query.  Ex: "read data into pandas dataframe"
+        k : int
+            the number of nearest neighbors to return.
+        """
+        return self.search_batch([query], k, num_threads=1)[0]
+
+    def print_results(self, query: str, k: int = 5) -> None:
+        """Prints the code that are the nearest neighbors to the search query, as the notebook did."""
+        for result in self.search(query, k):
+            print(f'cosine dist:{result.distance:.4f}  url: {result.url}\n---------------\n')
+            print(result.code)
@@ -0,0 +1,279 @@
+"""
+Nearest neighbor indexes (by cosine distance) with the query interface of nmslib, so that the
+search engine and the evaluation do not depend on which backend is used:
+
+    search_index = create_index(vectors, backend='ivf', nlist=4096)
+    search_index.save('./data/search/search_index.ivf')
+    search_index = load_index('./data/search/search_index.ivf')
+    idxs, dists = search_index.knnQuery(query, k=10)
+
+Backends are 'exact' (blocked matrix products), 'ivf' (inverted lists of k-means clusters, in numpy)
+and 'nmslib' (HNSW). Every backend saves its data to one file and its parameters, with a checksum of
+the vectors, to `<file>.meta.json` (like `general_utils.create_nmslib_search_index`, whose indexes
+`load_index` also reads).
+"""
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from general_utils import create_nmslib_search_index, exact_knn, index_meta_file, vectors_checksum
+
+try:
+    import nmslib
+except ImportError:
+    nmslib = None
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+class SearchIndex:
+    """
+    Base class of the backends: `add` vectors, `build`, then `knnQuery` or `knnQueryBatch`, which
+    return (indices, cosine distances) of the nearest vectors, nearest first, like nmslib.
+    """
+    backend = None
+
+    def __init__(self, **index_params):
+        self.index_params = index_params
+        self.query_params = {}
+        self.checksum = None
+        self._added = []
+
+    def add(self, vectors: np.ndarray) -> 'SearchIndex':
+        self._added.append(np.asarray(vectors, dtype=np.float32))
+        return self
+
+    def build(self) -> 'SearchIndex':
+        vectors = np.concatenate(self._added)
+        self._added = []
+        self.checksum = vectors_checksum(vectors)
+        self._build(vectors)
+        return self
+
+    def setQueryTimeParams(self, params: dict) -> None:
+        self.query_params.update(params)
+
+    def knnQuery(self, vector: np.ndarray, k: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        return self._search(np.asarray(vector, dtype=np.float32).reshape(1, -1), k)[0]
+
+    def knnQueryBatch(self, queries: np.ndarray, k: int = 10, num_threads: int = 0) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """(indices, distances) of every query, searched by `num_threads` threads (0 for one per cpu)."""
+        queries = np.asarray(queries, dtype=np.float32)
+        num_threads = min(num_threads or cpu_count(), len(queries))
+        if num_threads <= 1:
+            return self._search(queries, k)
+        with ThreadPoolExecutor(num_threads) as pool:
+            parts = pool.map(lambda part: self._search(part, k), np.array_split(queries, num_threads))
+            return [result for part in parts for result in part]
+
+    def save(self, fname: str) -> None:
+        self._save(str(fname))
+        meta = {'backend': self.backend, 'index_params': self.index_params,
+                'query_params': self.query_params, 'vectors': self.checksum}
+        with open(index_meta_file(fname), 'w') as f:
+            json.dump(meta, f, indent=2)
+        logging.warning(f'Saved {self.backend} search index to {fname}')
+
+    def _build(self, vectors: np.ndarray) -> None:
+        raise NotImplementedError
+
+    def _search(self, queries: np.ndarray, k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        raise NotImplementedError
+
+    def _save(self, fname: str) -> None:
+        raise NotImplementedError
+
+    def _load(self, fname: str) -> None:
+        raise NotImplementedError
+
+
+class ExactIndex(SearchIndex):
+    """Exact search: the queries are multiplied with `block_size` (normalized) vectors at a time."""
+    backend = 'exact'
+
+    def __init__(self, block_size: int = 100000):
+        super().__init__(block_size=block_size)
+        self.vectors = None
+
+    def _build(self, vectors):
+        self.vectors = normalize(vectors)
+
+    def _search(self, queries, k):
+        idxs, dists = exact_knn(self.vectors, normalize(queries), k, self.index_params['block_size'], normalized=True)
+        return [(i.astype(np.int32), d.astype(np.float32)) for i, d in zip(idxs, dists)]
+
+    def _save(self, fname):
+        with open(fname, 'wb') as f:
+            np.save(f, self.vectors)
+
+    def _load(self, fname):
+        self.vectors = np.load(fname, mmap_mode='r')
+
+
+class IVFIndex(SearchIndex):
+    """
+    Inverted file index: the vectors are clustered into `nlist` lists by spherical k-means (on a
+    sample of `sample_size` vectors), and a query is only compared to the vectors of the `nprobe`
+    lists with the closest centroids (a query time parameter: higher gives better recall, slower).
+    """
+    backend = 'ivf'
+
+    def __init__(self, nlist: int = None, nprobe: int = 16, n_iter: int = 10, sample_size: int = 100000,
+                 seed: int = 0):
+        super().__init__(nlist=nlist, n_iter=n_iter, sample_size=sample_size, seed=seed)
+        self.query_params = {'nprobe': nprobe}
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray, block_size: int = 100000) -> np.ndarray:
+        return np.concatenate([np.argmax(vectors[start:start + block_size] @ centroids.T, axis=1)
+                               for start in range(0, len(vectors), block_size)])
+
+    def _build(self, vectors):
+        vectors = normalize(vectors)
+        rng = np.random.RandomState(self.index_params['seed'])
+        sample = vectors[rng.choice(len(vectors), min(self.index_params['sample_size'], len(vectors)), replace=False)]
+        nlist = min(self.index_params['nlist'] or int(4 * np.sqrt(len(vectors))) or 1, len(sample))
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(self.index_params['n_iter']):
+            assignment = self._assign(sample, centroids)
+            order = np.argsort(assignment, kind='stable')
+            counts = np.bincount(assignment, minlength=nlist)
+            starts = np.cumsum(counts) - counts
+            # empty lists keep their centroid
+            centroids[counts > 0] = normalize(np.add.reduceat(sample[order], starts[counts > 0], axis=0))
+        assignment = self._assign(vectors, centroids)
+        order = np.argsort(assignment, kind='stable')
+        self.centroids = centroids
+        self.ids = order.astype(np.int32)
+        self.vectors = vectors[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))])
+
+    def _search(self, queries, k):
+        queries = normalize(queries)
+        nprobe = min(self.query_params['nprobe'], len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        results = []
+        for query, lists in zip(queries, probes):
+            rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+            sim = self.vectors[rows] @ query
+            top = np.argpartition(-sim, k - 1)[:k] if len(sim) > k else np.arange(len(sim))
+            top = top[np.argsort(-sim[top], kind='stable')]
+            results.append((self.ids[rows[top]], (1. - sim[top]).astype(np.float32)))
+        return results
+
+    def _save(self, fname):
+        with open(fname, 'wb') as f:
+            np.savez(f, centroids=self.centroids, ids=self.ids, vectors=self.vectors, offsets=self.offsets)
+
+    def _load(self, fname):
+        with np.load(fname) as data:
+            self.centroids, self.ids = data['centroids'], data['ids']
+            self.vectors, self.offsets = data['vectors'], data['offsets']
+
+
+class NmslibIndex(SearchIndex):
+    """nmslib's HNSW, see `general_utils.create_nmslib_search_index` for the parameters."""
+    backend = 'nmslib'
+
+    def __init__(self, M: int = 16, efConstruction: int = 200, post: int = 2, indexThreadQty: int = None,
+                 efSearch: int = None):
+        if nmslib is None:
+            raise ImportError('nmslib is not installed, use the exact or ivf backend')
+        super().__init__(M=M, efConstruction=efConstruction, post=post, indexThreadQty=indexThreadQty)
+        self.query_params = {'efSearch': efSearch} if efSearch else {}
+        self.index = None
+
+    def _build(self, vectors):
+        self.index = create_nmslib_search_index(vectors, efSearch=self.query_params.get('efSearch'),
+                                                print_progress=False, **self.index_params)
+
+    def setQueryTimeParams(self, params):
+        super().setQueryTimeParams(params)
+        if self.index is not None:
+            self.index.setQueryTimeParams(self.query_params)
+
+    def knnQuery(self, vector, k=10):
+        return self.index.knnQuery(vector, k=k)
+
+    def knnQueryBatch(self, queries, k=10, num_threads=0):
+        return self.index.knnQueryBatch(queries, k=k, num_threads=num_threads)
+
+    def _save(self, fname):
+        self.index.saveIndex(fname)
+
+    def _load(self, fname):
+        self.index = nmslib.init(method='hnsw', space='cosinesimil')
+        self.index.loadIndex(fname)
+        if self.query_params:
+            self.index.setQueryTimeParams(self.query_params)
+
+
+BACKENDS = {'exact': ExactIndex, 'ivf': IVFIndex, 'nmslib': NmslibIndex}
+
+
+def default_backend() -> str:
+    """nmslib, or ivf when nmslib is not installed."""
+    if nmslib is None:
+        logging.warning('nmslib is not installed, using the ivf backend')
+        return 'ivf'
+    return 'nmslib'
+
+
+def create_index(vectors: np.ndarray, backend: str = None, **params) -> SearchIndex:
+    """
+    Build an index of `vectors` with a backend of `BACKENDS` and its parameters (index and query
+    time ones alike). By default nmslib, or ivf when nmslib is not installed.
+    """
+    if backend is None:
+        backend = default_backend()
+    assert backend in BACKENDS, f'Unknown backend {backend}, one of {list(BACKENDS)}'
+    return BACKENDS[backend](**params).add(vectors).build()
+
+
+def load_index(fname: str, vectors: np.ndarray = None) -> SearchIndex:
+    """
+    Load an index saved by `SearchIndex.save` (or `create_nmslib_search_index`). Given the vectors
+    the index refers to, check that they are the ones it was built from.
+    """
+    with open(index_meta_file(fname)) as f:
+        meta = json.load(f)
+    if vectors is not None:
+        checksum = vectors_checksum(vectors)
+        assert checksum == meta['vectors'], f'{fname} was built from other vectors: {meta["vectors"]} != {checksum}'
+    search_index = BACKENDS[meta.get('backend', 'nmslib')](**meta['index_params'])
+    search_index.query_params = meta['query_params']
+    search_index.checksum = meta['vectors']
+    search_index._load(str(fname))
+    return search_index
+
+
+def benchmark_backends(vectors: np.ndarray,
+                       queries: np.ndarray,
+                       backends: Dict[str, dict],
+                       k: int = 10,
+                       num_threads: int = 0) -> List[dict]:
+    """
+    Build time, batch query time and recall@k (against the exact backend) of backends, given as
+    {name: params} with names of `BACKENDS`, e.g. `{'ivf': {'nprobe': 32}, 'nmslib': {'efSearch': 100}}`.
+    """
+    exact = [set(idxs) for idxs, _ in ExactIndex().add(vectors).build().knnQueryBatch(queries, k, num_threads)]
+    results = []
+    for backend, params in backends.items():
+        start = time.perf_counter()
+        search_index = create_index(vectors, backend, **params)
+        build_s = time.perf_counter() - start
+        start = time.perf_counter()
+        found = search_index.knnQueryBatch(queries, k, num_threads)
+        query_ms = (time.perf_counter() - start) / len(queries) * 1000.
+        recall = np.mean([len(set(idxs) & e) / k for (idxs, _), e in zip(found, exact)])
+        results.append(dict(params, backend=backend, recall=float(recall), build_s=build_s, query_ms=query_ms))
+        logging.warning(json.dumps(results[-1]))
+    return results
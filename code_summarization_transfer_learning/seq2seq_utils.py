@@ -344,6 +344,57 @@ class Seq2Seq_Inference(object):
 
         return original_encoding, ' '.join(decoded_sentence)
 
+    def predict_batch(self,
+                      raw_input_texts,
+                      max_len=None,
+                      batch_size=256):
+        """
+        `predict` for a list of inputs at once: the inputs are encoded together and the decoder is
+        stepped for all the outputs not finished yet, each output stopping at its own `_end_`
+        token (or `max_len`), so the outputs are the same as with `predict`.
+
+        Inputs
+        ------
+        raw_input_texts: List[str]
+            The bodies of what is to be summarized or translated.
+
+        max_len: int (optional)
+            The maximum length of the outputs
+
+        batch_size: int
+            Batch size of the keras models' predictions.
+
+        Returns
+        -------
+        Tuple(np.array, List[str])
+            The encoder's features of every input, and the decoded outputs.
+        """
+        if max_len is None:
+            max_len = self.default_max_len
+        raw_tokenized = self.enc_pp.transform(raw_input_texts)
+        encoding = self.encoder_model.predict(raw_tokenized, batch_size=batch_size)
+        original_encoding = encoding
+        decoded_sentences = [[] for _ in range(len(raw_tokenized))]
+        # rows of the outputs that are not finished yet
+        active = np.arange(len(raw_tokenized))
+        state_value = np.full((len(active), 1), self.dec_pp.token2id['_start_'])
+
+        while len(active):
+            preds, st = self.decoder_model.predict([state_value, encoding], batch_size=batch_size)
+            # ignore indices 0 (padding) and 1 (unknown), as in `predict`
+            pred_idx = np.argmax(preds[:, -1, 2:], axis=-1) + 2
+            pred_words = [self.dec_pp.id2token[idx] for idx in pred_idx]
+            lengths = np.array([len(decoded_sentences[row]) for row in active])
+            keep = np.array([word != '_end_' for word in pred_words]) & (lengths < max_len)
+            for row, word, k in zip(active, pred_words, keep):
+                if k:
+                    decoded_sentences[row].append(word)
+
+            # update the decoder for the next word of the unfinished outputs
+            active, encoding, state_value = active[keep], st[keep], pred_idx[keep].reshape(-1, 1)
+
+        return original_encoding, [' '.join(sentence) for sentence in decoded_sentences]
+
 
     def print_example(self,
                       i,
@@ -406,7 +457,7 @@ class Seq2Seq_Inference(object):
                                url=url[i],
                                threshold=threshold)
 
-    def evaluate_model(self, input_strings, output_strings, max_len):
+    def evaluate_model(self, input_strings, output_strings, max_len, batch_size=256):
         """
         Method for calculating BLEU Score.
 
@@ -416,6 +467,8 @@ class Seq2Seq_Inference(object):
             These are the issue bodies that we want to summarize
         output_strings : List[str]
             This is the ground truth we are trying to predict --> issue titles
+        batch_size : int
+            Number of inputs decoded at once, see `predict_batch`.
 
         Returns
         -------
@@ -427,13 +480,16 @@ class Seq2Seq_Inference(object):
         assert len(input_strings) == len(output_strings)
         num_examples = len(input_strings)
 
+        input_strings, output_strings = list(input_strings), list(output_strings)
+
         logging.warning('Generating predictions.')
-        # step over the whole set TODO: parallelize this
-        for i in tqdm_notebook(range(num_examples)):
-            _, yhat = self.predict(input_strings[i], max_len)
+        # step over the whole set, a batch of inputs at a time
+        for start in tqdm_notebook(range(0, num_examples, batch_size)):
+            _, yhats = self.predict_batch(input_strings[start:start + batch_size], max_len, batch_size)
 
-            self.actual.append(self.dec_pp.process_text([output_strings[i]])[0])
-            self.predicted.append(self.dec_pp.process_text([yhat])[0])
+            for output_string, yhat in zip(output_strings[start:start + batch_size], yhats):
+                self.actual.append(self.dec_pp.process_text([output_string])[0])
+                self.predicted.append(self.dec_pp.process_text([yhat])[0])
         # calculate BLEU score
         logging.warning('Calculating BLEU.')
         bleu = corpus_bleu([[a] for a in self.actual], self.predicted)
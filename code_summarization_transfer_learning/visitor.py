@@ -386,3 +386,196 @@ class ASTVisitor(ast.NodeVisitor):
                 self.api_seq.append(value)
         else:
             self.api_seq.append(value)
+
+
+class IterativeASTVisitor:
+    """
+    Same api sequence as `ASTVisitor`, without recursion: the nodes and tokens still to visit are
+    kept on an explicit stack, so deeply nested (e.g. generated) code cannot hit the recursion
+    limit, and handlers are looked up by node type instead of by method name.
+
+    With `structural=True` it also emits the keywords of with statements, try blocks and
+    comprehensions and the names of keyword arguments, and visits the body of for loops
+    (which `ASTVisitor.visit_For` skips). This changes the api sequences, so models trained on
+    the default sequences need to be retrained to use it.
+    """
+
+    def __init__(self, structural=False):
+        self.api_seq = []
+        self.structural = structural
+        self._stack = []
+
+    def visit(self, node):
+        stack = self._stack
+        handlers = self._handlers
+        stack.append(node)
+        while stack:
+            item = stack.pop()
+            if item is None:
+                continue
+            if type(item) is tuple:  # a token that comes after some child nodes
+                self.append(item[0])
+                continue
+            handler = handlers.get(type(item))
+            if handler is None:
+                self._generic(item)
+            else:
+                handler(self, item)
+
+    def append(self, value):
+        if isinstance(value, str):
+            value = value.strip()
+            if value:
+                self.api_seq.append(value)
+        else:
+            self.api_seq.append(value)
+
+    def _push_all(self, nodes):
+        self._stack.extend(reversed(nodes))
+
+    def _generic(self, node):
+        stack = self._stack
+        for name in reversed(node._fields):
+            value = getattr(node, name, None)
+            if isinstance(value, list):
+                stack.extend(item for item in reversed(value) if isinstance(item, ast.AST))
+            elif isinstance(value, ast.AST):
+                stack.append(value)
+
+    def _visit_Assign(self, node):
+        self._stack.append(node.value)
+        self._push_all(node.targets)
+
+    def _visit_If(self, node):
+        self.append('if')
+        self._push_all(node.orelse)
+        self._stack.append(('else',))
+        self._push_all(node.body)
+        self._stack.append(node.test)
+
+    def _visit_For(self, node, is_async=False):
+        if is_async:
+            self.append('async')
+        self.append('for')
+        if node.orelse:
+            self._push_all(node.orelse)
+            self._stack.append(('else',))
+        if self.structural:
+            self._push_all(node.body)
+        self._stack.append(node.iter)
+        self._stack.append(node.target)
+
+    def _visit_AsyncFor(self, node):
+        if self.structural:
+            self._visit_For(node, is_async=True)
+        else:
+            self._generic(node)
+
+    def _visit_While(self, node):
+        self.append('while')
+        if node.orelse:
+            self._push_all(node.orelse)
+            self._stack.append(('else',))
+        self._push_all(node.body)
+        self._stack.append(node.test)
+
+    def _visit_With(self, node, is_async=False):
+        if self.structural:
+            if is_async:
+                self.append('async')
+            self.append('with')
+        self._generic(node)
+
+    def _visit_AsyncWith(self, node):
+        self._visit_With(node, is_async=True)
+
+    def _visit_Try(self, node):
+        if not self.structural:
+            return self._generic(node)
+        self.append('try')
+        if node.finalbody:
+            self._push_all(node.finalbody)
+            self._stack.append(('finally',))
+        if node.orelse:
+            self._push_all(node.orelse)
+            self._stack.append(('else',))
+        self._push_all(node.handlers)
+        self._push_all(node.body)
+
+    def _visit_ExceptHandler(self, node):
+        if self.structural:
+            self.append('except')
+        self._generic(node)
+
+    def _visit_Call(self, node):
+        if not self.structural:
+            return self._generic(node)
+        stack = self._stack
+        for keyword in reversed(node.keywords):
+            stack.append(keyword.value)
+            # a keyword.arg of None indicates dictionary unpacking
+            stack.append((keyword.arg or '',))
+        self._push_all(node.args)
+        stack.append(node.func)
+
+    def _visit_comprehension(self, node):
+        if not self.structural:
+            return self._generic(node)
+        if getattr(node, 'is_async', False):
+            self.append('async')
+        self.append('for')
+        for if_ in reversed(node.ifs):
+            self._stack.append(if_)
+            self._stack.append(('if',))
+        self._stack.append(node.iter)
+        self._stack.append(node.target)
+
+    def _visit_Constant(self, node):
+        # like the visit_NameConstant, visit_Num, visit_Str and visit_Bytes of `ASTVisitor`
+        value = node.value
+        if isinstance(value, bytes):
+            self.append(repr(value))
+        elif isinstance(value, (str, bool, int, float, complex)) or value is None:
+            self.append(value)
+
+    def _visit_Pass(self, node):
+        self.append('pass')
+
+    def _visit_Return(self, node):
+        self.append('return')
+        self._stack.append(node.value)
+
+    def _visit_Break(self, node):
+        self.append('break')
+
+    def _visit_Continue(self, node):
+        self.append('continue')
+
+    def _visit_Raise(self, node):
+        self.append('raise')
+        self._stack.append(node.exc)
+
+    def _visit_Attribute(self, node):
+        self._stack.append((node.attr,))
+        self._stack.append(node.value)
+
+    def _visit_Name(self, node):
+        self.append(node.id)
+
+    if sys.version_info < (3, 8):
+        def _visit_NameConstant(self, node):
+            self.append(node.value)
+
+        def _visit_Num(self, node):
+            self.append(node.n)
+
+        def _visit_Str(self, node):
+            self.append(node.s)
+
+        def _visit_Bytes(self, node):
+            self.append(repr(node.s))
+
+
+IterativeASTVisitor._handlers = {getattr(ast, name[len('_visit_'):]): method
+                                 for name, method in vars(IterativeASTVisitor).items()
+                                 if name.startswith('_visit_') and hasattr(ast, name[len('_visit_'):])}
@@ -0,0 +1,269 @@
+"""
+Benchmarks of the search path on synthetic corpora of normalized code vectors.
+
+Every (backend, corpus size) case runs in a fresh process so that its peak RSS is its own.
+Results are written as json, and can be checked against the results of a previous release:
+
+    python benchmarks.py --sizes 10000 100000 1000000 --out bench.json
+    python benchmarks.py --sizes 10000 100000 1000000 --baseline bench.json
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from bundle import write_bundle
+from codesearcher import CodeSearcher
+from configs import get_java_config, get_python_config
+from segments import SegmentedIndex
+from utils import normalize, dot_np
+
+logger = logging.getLogger(__name__)
+
+# general_utils.py of the notebooks, whose nmslib index the `nmslib` backend builds and loads
+NOTEBOOKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code_summarization_transfer_learning')
+BACKENDS = ['threads', 'blocked', 'blocked_batch', 'segments', 'nmslib']
+# metrics where larger is better, every other metric is a cost
+HIGHER_IS_BETTER = {'qps'}
+
+
+def make_corpus(path, n_vectors, dim, block_size=100000, seed=42):
+    """write a normalized float32 [n_vectors x dim] corpus, a matching codebase and an index bundle"""
+    rng = np.random.RandomState(seed)
+    os.makedirs(path)
+    vecs = np.lib.format.open_memmap(os.path.join(path, 'vecs.npy'), mode='w+', dtype='float32',
+                                     shape=(n_vectors, dim))
+    for i in range(0, n_vectors, block_size):
+        n = min(block_size, n_vectors - i)
+        vecs[i:i + n] = normalize(rng.randn(n, dim).astype('float32'))
+    vecs.flush()
+    with open(os.path.join(path, 'codebase.txt'), 'w') as f:
+        for i in range(n_vectors):
+            f.write('def function_%d(): pass\n' % i)
+    with open(os.path.join(path, 'vocab.desc.pkl'), 'wb') as f:
+        pickle.dump({}, f)
+    start = time.perf_counter()
+    write_bundle(os.path.join(path, 'corpus.bundle'), vecs, os.path.join(path, 'codebase.txt'),
+                 os.path.join(path, 'vocab.desc.pkl'), {})
+    return time.perf_counter() - start
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. ** 2 if sys.platform == 'darwin' else rss / 1024.  # bytes on macOS, KB elsewhere
+
+
+def build_backend(backend, conf, path, n_segments):
+    """
+    return (timings, query function) for a backend: timings has the build seconds (and the load
+    seconds of backends saved to disk), the query function takes normalized query vectors
+    [n x dim] and the number of results.
+    """
+    start = time.perf_counter()
+    if backend in ('threads', 'blocked', 'blocked_batch'):
+        searcher = CodeSearcher(conf, bundle=os.path.join(path, 'corpus.bundle'))
+        timings = {'build_s': time.perf_counter() - start}
+        if backend == 'threads':
+            return timings, lambda queries, k: searcher.search_repr(queries, k)
+        return timings, lambda queries, k: searcher.search_batch(queries, k)
+
+    vecs = np.load(os.path.join(path, 'vecs.npy'), mmap_mode='r')
+    if backend == 'segments':
+        index = SegmentedIndex(os.path.join(path, 'segments'))
+        with open(os.path.join(path, 'codebase.txt')) as f:
+            codes = f.readlines()
+        bounds = np.linspace(0, len(vecs), n_segments + 1).astype('int64')
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            index.add(vecs[lo:hi], codes[lo:hi])
+        timings = {'build_s': time.perf_counter() - start}
+        return timings, lambda queries, k: index.search(queries, k, conf['search_block_size'])
+
+    if backend == 'nmslib':
+        # the build and load path of the notebooks' search index, with its default parameters
+        sys.path.insert(0, NOTEBOOKS_DIR)
+        from general_utils import create_nmslib_search_index, load_nmslib_search_index
+        index_file = os.path.join(path, 'search_index.nmslib')
+        create_nmslib_search_index(vecs, save_path=index_file, print_progress=False)
+        timings = {'build_s': time.perf_counter() - start}
+        start = time.perf_counter()
+        index = load_nmslib_search_index(index_file)
+        timings['load_s'] = time.perf_counter() - start
+        return timings, lambda queries, k: index.knnQueryBatch(queries, k=k, num_threads=1)
+
+    raise ValueError('Unknown backend {}'.format(backend))
+
+
+def run_case(backend, conf, path, n_queries, n_results, concurrency, duration, n_segments):
+    """benchmark one backend on one corpus, meant to run in its own process"""
+    dim = conf['n_hidden']
+    rng = np.random.RandomState(0)
+    queries = normalize(rng.randn(n_queries, dim).astype('float32'))
+    timings, query = build_backend(backend, conf, path, n_segments)
+
+    batch_size = conf['search_batch_size'] if backend == 'blocked_batch' else 1
+    batches = [queries[i:i + batch_size] for i in range(0, n_queries, batch_size)]
+    query(batches[0], n_results)  # warm up
+
+    latencies = []
+    for batch in batches:
+        start = time.perf_counter()
+        query(batch, n_results)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000.
+
+    def worker(offset):
+        n, i, deadline = 0, offset, time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            n += len(batches[i % len(batches)])
+            query(batches[i % len(batches)], n_results)
+            i += 1
+        return n
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        n_done = sum(pool.map(worker, range(concurrency)))
+    qps = n_done / (time.perf_counter() - start)
+
+    return {'benchmark': backend,
+            'n_vectors': int(np.load(os.path.join(path, 'vecs.npy'), mmap_mode='r').shape[0]),
+            'batch_size': batch_size,
+            **timings,
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'qps': qps,
+            'concurrency': concurrency,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def run_primitives(conf, path, n_queries, block_size=100000):
+    """
+    `normalize` over the corpus and single query `dot_np` against it, `block_size` vectors at a
+    time from the memory mapped corpus, so that the largest corpora do not have to fit in memory
+    """
+    vecs = np.load(os.path.join(path, 'vecs.npy'), mmap_mode='r')
+    queries = normalize(np.random.RandomState(0).randn(n_queries, conf['n_hidden']).astype('float32'))
+    start = time.perf_counter()
+    for i in range(0, len(vecs), block_size):
+        normalize(vecs[i:i + block_size])
+    normalize_s = time.perf_counter() - start
+    latencies = []
+    for i in range(n_queries):
+        start = time.perf_counter()
+        for j in range(0, len(vecs), block_size):
+            dot_np(queries[i:i + 1], vecs[j:j + block_size])
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000.
+    return [{'benchmark': 'normalize', 'n_vectors': len(vecs), 'seconds': normalize_s},
+            {'benchmark': 'dot_np', 'n_vectors': len(vecs),
+             'p50_ms': float(np.percentile(latencies, 50)),
+             'p99_ms': float(np.percentile(latencies, 99))}]
+
+
+def in_subprocess(func, *args):
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+def compare(results, baseline, tolerance):
+    """regressions of more than `tolerance` (relative) against the matching baseline results"""
+    def key(r):
+        return r['benchmark'], r['n_vectors'], r.get('batch_size')
+
+    previous = {key(r): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        for metric, value in result.items():
+            if not isinstance(value, float) or not old.get(metric):
+                continue
+            change = (value - old[metric]) / old[metric]
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > tolerance:
+                regressions.append({'benchmark': result['benchmark'], 'n_vectors': result['n_vectors'],
+                                    'metric': metric, 'baseline': old[metric], 'value': value})
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark the code search path on synthetic corpora")
+    parser.add_argument("--language", choices=["java", "python"], default="java",
+                        help="Config that gives n_hidden and the search parameters")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[10000, 100000, 1000000, 10000000],
+                        help="Number of code vectors of each synthetic corpus")
+    parser.add_argument("--backends", nargs='+', choices=BACKENDS, default=BACKENDS)
+    parser.add_argument("--n_queries", type=int, default=200, help="Queries timed one by one")
+    parser.add_argument("--n_results", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=4, help="Threads issuing queries for qps")
+    parser.add_argument("--duration", type=float, default=10., help="Seconds of concurrent queries")
+    parser.add_argument("--n_segments", type=int, default=4, help="Segments of the `segments` backend")
+    parser.add_argument("--workdir", help="Where corpora are generated, a temporary directory by default")
+    parser.add_argument("--out", help="Write results as json to this file")
+    parser.add_argument("--baseline", help="Json results of a previous run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Relative change of a metric, against the baseline, counted as a regression")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    conf = get_java_config() if args.language == 'java' else get_python_config()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='codesearch-bench-')
+    # the nmslib backend also needs the dependencies of general_utils
+    missing = [m for m in ('nmslib', 'wget', 'more_itertools') if importlib.util.find_spec(m) is None]
+    if 'nmslib' in args.backends and missing:
+        logger.warning('{} not installed, skipping the nmslib benchmarks'.format(', '.join(missing)))
+        args.backends.remove('nmslib')
+
+    results = []
+    for n_vectors in args.sizes:
+        path = os.path.join(workdir, 'corpus-%d' % n_vectors)
+        logger.info('Generating corpus of {} vectors of size {}'.format(n_vectors, conf['n_hidden']))
+        bundle_s = make_corpus(path, n_vectors, conf['n_hidden'])
+        results.append({'benchmark': 'bundle', 'n_vectors': n_vectors, 'build_s': bundle_s})
+        results.extend(in_subprocess(run_primitives, conf, path, args.n_queries))
+        for backend in args.backends:
+            logger.info('Benchmarking {} on {} vectors'.format(backend, n_vectors))
+            results.append(in_subprocess(run_case, backend, conf, path, args.n_queries, args.n_results,
+                                         args.concurrency, args.duration, args.n_segments))
+            logger.info(json.dumps(results[-1]))
+        if args.workdir is None:
+            shutil.rmtree(path)
+
+    report = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'torch': torch.__version__,
+                       'platform': platform.platform(),
+                       'cpu_count': os.cpu_count(),
+                       'n_hidden': conf['n_hidden'],
+                       'args': vars(args)},
+              'results': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            logger.warning('Regression: {}'.format(json.dumps(regression)))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,131 @@
+import glob
+import io
+import json
+import mmap
+import os
+import pickle
+import shutil
+import struct
+
+import numpy as np
+import torch
+
+from data import SnippetStore, load_line_offsets
+
+MAGIC = b'DCSBUNDL'
+VERSION = 1
+# sections start on a multiple of this, so each one can be memory mapped on its own
+ALIGNMENT = max(4096, mmap.ALLOCATIONGRANULARITY)
+# magic, version, length of the json header that follows
+PREAMBLE = struct.Struct('<8sII')
+
+
+class IndexBundle:
+    """
+    Everything the searcher needs in a single, versioned, memory mapped file:
+
+        vectors          normalized code vectors [n x n_hidden]
+        snippet_offsets  byte offsets of the raw code snippets [n + 1]
+        snippets         raw code snippets, one per line
+        vocab_desc       pickled description vocabulary
+        desc_encoder     description encoder weights (torch state dict)
+
+    The file starts with a preamble and a json table of the sections (offset, length and,
+    for arrays, dtype and shape). Every section is page aligned.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.version = _version(path, os.fstat(f.fileno()))
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_len = PREAMBLE.unpack_from(self.mm, 0)
+        assert magic == MAGIC, '%s is not an index bundle' % path
+        assert version == VERSION, 'Unsupported index bundle version %d' % version
+        header = json.loads(self.mm[PREAMBLE.size:PREAMBLE.size + header_len].decode('utf-8'))
+        self.sections = header['sections']
+        self.meta = header['meta']
+
+        self.vectors = self.array('vectors')
+        self.snippet_offsets = self.array('snippet_offsets')
+        self.snippets = SnippetStore(self.section('snippets'), self.snippet_offsets)
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def section(self, name):
+        """zero-copy view of a section"""
+        section = self.sections[name]
+        return memoryview(self.mm)[section['offset']:section['offset'] + section['length']]
+
+    def array(self, name):
+        section = self.sections[name]
+        return np.frombuffer(self.mm, dtype=section['dtype'], count=int(np.prod(section['shape'])),
+                             offset=section['offset']).reshape(section['shape'])
+
+    def vocab_desc(self):
+        return pickle.loads(self.section('vocab_desc'))
+
+    def desc_encoder_state(self):
+        return torch.load(io.BytesIO(self.section('desc_encoder')), map_location='cpu')
+
+    def load_desc_encoder(self, model):
+        """load the bundled description encoder weights into a JointEmbedding"""
+        model.desc_encoder.load_state_dict(self.desc_encoder_state())
+
+
+def _version(path, stat):
+    return path, stat.st_ino, stat.st_mtime_ns
+
+
+def bundle_version(path):
+    """identifies the file currently at `path`; it changes when a new bundle is renamed over it"""
+    return _version(path, os.stat(path))
+
+
+def latest_bundle(bundle_dir):
+    """the newest `*.bundle` of a directory, by name (e.g. a date stamp), or None"""
+    bundles = sorted(glob.glob(os.path.join(bundle_dir, '*.bundle')))
+    return bundles[-1] if bundles else None
+
+
+def write_bundle(path, vecs, codebase_file, vocab_desc_file, desc_encoder_state, meta=None):
+    """
+    write an index bundle; the raw codebase and the vocabulary pickle are copied as they are.
+    The bundle is written next to `path` and renamed over it, so readers never see a partial file.
+    """
+    offsets = load_line_offsets(codebase_file)
+    assert len(offsets) - 1 == vecs.shape[0], \
+        'Codebase has %d snippets for %d vectors' % (len(offsets) - 1, vecs.shape[0])
+    encoder = io.BytesIO()
+    torch.save(desc_encoder_state, encoder)
+
+    sections = {}
+    pos = ALIGNMENT  # the first page is reserved for the header
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        def add_section(name, write, **info):
+            nonlocal pos
+            f.seek(pos)
+            write(f)
+            length = f.tell() - pos
+            sections[name] = dict(offset=pos, length=length, **info)
+            pos += max(1, -(-length // ALIGNMENT)) * ALIGNMENT
+
+        for name, arr in [('vectors', np.ascontiguousarray(vecs)), ('snippet_offsets', offsets)]:
+            add_section(name, lambda f: f.write(arr.tobytes()), dtype=arr.dtype.str, shape=list(arr.shape))
+        with open(codebase_file, 'rb') as codebase:
+            add_section('snippets', lambda f: shutil.copyfileobj(codebase, f))
+        with open(vocab_desc_file, 'rb') as vocab:
+            add_section('vocab_desc', lambda f: shutil.copyfileobj(vocab, f))
+        add_section('desc_encoder', lambda f: f.write(encoder.getvalue()))
+        f.truncate(pos)
+
+        header = json.dumps({'sections': sections, 'meta': meta or {}}).encode('utf-8')
+        assert PREAMBLE.size + len(header) <= ALIGNMENT, 'Index bundle header too large'
+        f.seek(0)
+        f.write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
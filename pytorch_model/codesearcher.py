@@ -1,11 +1,14 @@
 import argparse
 import codecs
+import copy
+import json
 import logging
 import math
 import os
 import random
 import threading
 import traceback
+from itertools import islice
 
 import numpy as np
 import torch
@@ -14,53 +17,160 @@ from tensorboardX import SummaryWriter
 from torch import optim
 from tqdm import tqdm, trange
 
+from bundle import IndexBundle, write_bundle, bundle_version, latest_bundle
 from configs import get_java_config, get_python_config
-from data import load_dict, load_vecs, save_vecs, CodeSearchJavaDataset, CodeSearchPythonDataSet
+from data import load_dict, load_vecs, save_vecs, load_line_offsets, CodeSearchJavaDataset, \
+    CodeSearchPythonDataSet
 from models import JointEmbedding
-from utils import normalize, dot_np, gVar, sent2indexes
+from segments import SegmentedIndex
+from utils import normalize, dot_np, gVar, sent2indexes, sents2indexes, block_topk, merge_topk
 
 random.seed(42)
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 
+class SearchState:
+    """
+    Everything a search reads: description vocabulary, code vectors, raw code and, for a
+    reloaded bundle, its own description encoder. Reloading builds a new state and swaps it in
+    with a single assignment, so every query runs on the state it started with and an old
+    state (with its memory maps) is released once the last query using it returns.
+    """
+
+    def __init__(self, vocab_desc=None):
+        self.vocab_desc = vocab_desc
+        self.codevecs = []
+        self.codebase = []
+        self.codebase_offsets = None
+        self.desc_encoder = None  # None: use the description encoder of the searching model
+        self.bundle = None
+
+
 class CodeSearcher:
-    def __init__(self, conf):
+    def __init__(self, conf, bundle=None):
         self.conf = conf
         self.path = conf['workdir']
 
-        self.vocab_methname = load_dict(self.path + conf['vocab_name'])
-        self.vocab_apiseq = load_dict(self.path + conf['vocab_api'])
-        self.vocab_tokens = load_dict(self.path + conf['vocab_tokens'])
-        self.vocab_desc = load_dict(self.path + conf['vocab_desc'])
-
-        self.codevecs = []
-        self.codebase = []
         self.codebase_chunksize = 2000000
+        self.index = None
+        self.watcher = None
+        self._stop_watching = threading.Event()
 
         self.valid_set = None
 
+        if bundle is not None:  # everything needed for searching comes from the bundle
+            self.vocab_methname = self.vocab_apiseq = self.vocab_tokens = None
+            self.state = self.open_bundle(bundle)
+        else:
+            self.vocab_methname = load_dict(self.path + conf['vocab_name'])
+            self.vocab_apiseq = load_dict(self.path + conf['vocab_api'])
+            self.vocab_tokens = load_dict(self.path + conf['vocab_tokens'])
+            self.state = SearchState(load_dict(self.path + conf['vocab_desc']))
+
+    @property
+    def bundle(self):
+        return self.state.bundle
+
     ##### Data Set #####
     def load_codebase(self):
         """load codebase
         codefile: h5 file that stores raw code
         """
         logger.info('Loading codebase (chunk size={})..'.format(self.codebase_chunksize))
-        if not self.codebase:  # empty
+        if not self.state.codebase:  # empty
             codes = codecs.open(self.path + self.conf['use_codebase']).readlines()
             # use codecs to read in case of encoding problem
             for i in range(0, len(codes), self.codebase_chunksize):
-                self.codebase.append(codes[i:i + self.codebase_chunksize])
+                self.state.codebase.append(codes[i:i + self.codebase_chunksize])
+
+    def load_codebase_offsets(self):
+        """index the byte offset of every snippet in the raw codebase without loading it"""
+        if self.state.codebase_offsets is None:
+            self.state.codebase_offsets = load_line_offsets(self.path + self.conf['use_codebase'])
+
+    def load_index(self):
+        """open the segmented index, searches then run over its live segments"""
+        if self.index is None:
+            self.index = SegmentedIndex(self.path + self.conf['index_dir'])
+
+    def open_bundle(self, bundle_path, model=None):
+        """
+        memory map an index bundle into a new search state: code vectors, raw code and the
+        description vocabulary. Given a model, the state gets a copy of its description encoder
+        holding the bundled weights, leaving the model itself untouched.
+        """
+        logger.info('Loading index bundle {}..'.format(bundle_path))
+        bundle = IndexBundle(bundle_path)
+        state = SearchState(bundle.vocab_desc())
+        state.bundle = bundle
+        vecs, snippets = bundle.vectors, bundle.snippets
+        state.codevecs = [vecs[i:i + self.codebase_chunksize]
+                          for i in range(0, len(vecs), self.codebase_chunksize)]
+        state.codebase = [snippets[i:i + self.codebase_chunksize]
+                          for i in range(0, len(snippets), self.codebase_chunksize)]
+        state.codebase_offsets = bundle.snippet_offsets
+        if model is not None:
+            state.desc_encoder = copy.deepcopy(model.desc_encoder)
+            state.desc_encoder.load_state_dict(bundle.desc_encoder_state())
+            state.desc_encoder.eval()
+        return state
+
+    def reload(self, model, bundle_dir):
+        """
+        open the newest bundle of `bundle_dir` if it is not the one being served, fault its
+        vectors into memory and swap it in. Returns whether the index changed.
+        """
+        bundle_path = latest_bundle(bundle_dir)
+        if bundle_path is None or (self.bundle is not None and
+                                   bundle_version(bundle_path) == self.bundle.version):
+            return False
+        state = self.open_bundle(bundle_path, model)
+        for codevecs_chunk in state.codevecs:  # warm up so the first queries do not page fault
+            for i in range(0, codevecs_chunk.shape[0], self.conf['search_block_size']):
+                codevecs_chunk[i:i + self.conf['search_block_size']].sum()
+        self.state = state
+        logger.info('Swapped in index bundle {}'.format(bundle_path))
+        return True
+
+    def watch(self, model, bundle_dir, interval=60):
+        """reload the index from `bundle_dir` in a background thread, checking every `interval` seconds"""
+
+        def watch_loop():
+            while not self._stop_watching.wait(interval):
+                try:
+                    self.reload(model, bundle_dir)
+                except Exception:
+                    logger.exception('Reloading index from {} failed'.format(bundle_dir))
+
+        self._stop_watching.clear()
+        self.watcher = threading.Thread(target=watch_loop, daemon=True)
+        self.watcher.start()
+
+    def stop_watching(self):
+        if self.watcher is not None:
+            self._stop_watching.set()
+            self.watcher.join()
+            self.watcher = None
+
+    def save_bundle(self, model, bundle_path):
+        """write `use_codevecs`, `use_codebase`, `vocab_desc` and the description encoder to a bundle"""
+        meta = {k: self.conf[k] for k in ['desc_len', 'n_words', 'emb_size', 'lstm_dims', 'n_hidden']}
+        meta['epoch'] = self.conf['reload']
+        write_bundle(bundle_path, load_vecs(self.path + self.conf['use_codevecs']),
+                     self.path + self.conf['use_codebase'], self.path + self.conf['vocab_desc'],
+                     model.desc_encoder.state_dict(), meta)
+        logger.info('Saved index bundle {}'.format(bundle_path))
 
                 ### Results Data ###
 
     def load_codevecs(self):
         logger.debug('Loading code vectors..')
-        if not self.codevecs:  # empty
+        if not self.state.codevecs:  # empty
             """read vectors (2D numpy array) from a hdf5 file"""
             reprs = load_vecs(self.path + self.conf['use_codevecs'])
             for i in range(0, reprs.shape[0], self.codebase_chunksize):
-                self.codevecs.append(reprs[i:i + self.codebase_chunksize])
+                self.state.codevecs.append(reprs[i:i + self.codebase_chunksize])
 
     ##### Model Loading / saving #####
     def save_model(self, model, epoch):
@@ -224,6 +334,12 @@ class CodeSearcher:
 
     ##### Compute Representation #####
     def repr_code(self, model, data_loader_class):
+        vecs = self.encode_code(model, data_loader_class)
+        save_vecs(vecs, self.path + self.conf['use_codevecs'])
+        return vecs
+
+    def encode_code(self, model, data_loader_class):
+        """normalized code vectors of the `use_*` dataset"""
         vecs = None
         use_set = data_loader_class(self.conf['workdir'],
                                     self.conf['use_names'], self.conf['name_len'],
@@ -236,22 +352,45 @@ class CodeSearcher:
             names, apis, toks = gVar(names), gVar(apis), gVar(toks)
             reprs = model.code_encoding(names, apis, toks).data.cpu().numpy()
             vecs = reprs if vecs is None else np.concatenate((vecs, reprs), 0)
-        vecs = normalize(vecs)
-        save_vecs(vecs, self.path + self.conf['use_codevecs'])
-        return vecs
+        return normalize(vecs)
+
+    def add_segment(self, model, data_loader_class):
+        """encode the `use_*` dataset and add it, with its raw code, as a new index segment"""
+        self.load_index()
+        vecs = self.encode_code(model, data_loader_class)
+        codes = codecs.open(self.path + self.conf['use_codebase']).readlines()
+        ids = self.index.add(vecs, codes)
+        logger.info('Added ids {}..{}'.format(ids.min(), ids.max()))
+        return ids
+
+    @staticmethod
+    def desc_encoder(state, model):
+        return state.desc_encoder if state.desc_encoder is not None else model.desc_encoder
 
     def search(self, model, query, n_results=10):
-        desc = sent2indexes(query, self.vocab_desc)  # convert desc sentence into word indices
+        state = self.state  # a reload swaps self.state, this query keeps its own
+        desc = sent2indexes(query, state.vocab_desc)  # convert desc sentence into word indices
         desc = np.expand_dims(desc, axis=0)
         desc = gVar(desc)
-        desc_repr = model.desc_encoding(desc).data.cpu().numpy()
-
+        desc_repr = self.desc_encoder(state, model)(desc).data.cpu().numpy()
+        return self.search_repr(desc_repr, n_results, state)
+
+    def search_repr(self, desc_repr, n_results=10, state=None):
+        """codes and similarities of the top `n_results` code vectors for one description vector"""
+        if self.index is not None:
+            inds, sims = self.index.search(normalize(desc_repr), n_results,
+                                           self.conf['search_block_size'])
+            ids = [k for k in inds[0] if k >= 0]
+            return [self.index.snippet(k) for k in ids], list(sims[0][:len(ids)])
+
+        state = state or self.state
         codes = []
         sims = []
         threads = []
-        for i, codevecs_chunk in enumerate(self.codevecs):
+        for i, codevecs_chunk in enumerate(state.codevecs):
             t = threading.Thread(target=self.search_thread,
-                                 args=(codes, sims, desc_repr, codevecs_chunk, i, n_results))
+                                 args=(codes, sims, desc_repr, codevecs_chunk, i, n_results,
+                                       state.codebase))
             threads.append(t)
         for t in threads:
             t.start()
@@ -259,7 +398,65 @@ class CodeSearcher:
             t.join()
         return codes, sims
 
-    def search_thread(self, codes, sims, desc_repr, codevecs, i, n_results):
+    def encode_descs(self, model, queries, state=None):
+        """encode a batch of query strings into normalized description vectors"""
+        state = state or self.state
+        descs = gVar(sents2indexes(queries, state.vocab_desc, self.conf['desc_len']))
+        with torch.no_grad():
+            desc_reprs = self.desc_encoder(state, model)(descs).data.cpu().numpy()
+        return normalize(desc_reprs)
+
+    def search_batch(self, desc_reprs, n_results=10, state=None):
+        """ids and similarities of the top `n_results` code vectors for each normalized query vector"""
+        if self.index is not None:
+            return self.index.search(desc_reprs, n_results, self.conf['search_block_size'])
+        state = state or self.state
+        inds, sims = None, None
+        offset = 0
+        for codevecs_chunk in state.codevecs:
+            chunk_inds, chunk_sims = block_topk(desc_reprs, codevecs_chunk, n_results,
+                                                self.conf['search_block_size'], offset)
+            inds, sims = merge_topk(inds, sims, chunk_inds, chunk_sims, n_results)
+            offset += codevecs_chunk.shape[0]
+        return inds, sims
+
+    def batch_search(self, model, query_file, out_file, n_results=10):
+        """
+        search every query (one per line) of `query_file` and write one json line per query
+        to `out_file` with the ids, similarities and byte offsets (in the raw codebase) of the results.
+        With a segmented index the offsets are into the `code.txt` of the segment listed under `segments`.
+        """
+        batch_size = self.conf['search_batch_size']
+        n_queries = 0
+        with codecs.open(query_file, encoding='utf-8') as fin, \
+                codecs.open(out_file, 'w', encoding='utf-8') as fout:
+            queries = (line.strip() for line in fin)
+            queries = (query for query in queries if query)
+            while True:
+                batch = list(islice(queries, batch_size))
+                if not batch:
+                    break
+                state = self.state
+                inds, sims = self.search_batch(self.encode_descs(model, batch, state), n_results, state)
+                if self.index is None:
+                    starts = state.codebase_offsets[inds].tolist()
+                    ends = state.codebase_offsets[inds + 1].tolist()
+                for j, query in enumerate(batch):
+                    ids = [k for k in inds[j].tolist() if k >= 0]
+                    result = {'query': query, 'ids': ids, 'scores': sims[j][:len(ids)].tolist()}
+                    if self.index is None:
+                        result['offsets'] = list(zip(starts[j], ends[j]))
+                    else:
+                        hits = [self.index.locate(k) for k in ids]
+                        result['segments'] = [segment.name for segment, _ in hits]
+                        result['offsets'] = [(int(segment.offsets[row]), int(segment.offsets[row + 1]))
+                                             for segment, row in hits]
+                    fout.write(json.dumps(result) + '\n')
+                n_queries += len(batch)
+                logger.info('searched {} queries'.format(n_queries))
+        return n_queries
+
+    def search_thread(self, codes, sims, desc_repr, codevecs, i, n_results, codebase=None):
         # 1. compute code similarities
         chunk_sims = dot_np(normalize(desc_repr), codevecs)
 
@@ -267,7 +464,8 @@ class CodeSearcher:
         negsims = np.negative(chunk_sims[0])
         maxinds = np.argpartition(negsims, kth=n_results - 1)
         maxinds = maxinds[:n_results]
-        chunk_codes = [self.codebase[i][k] for k in maxinds]
+        codebase = self.state.codebase if codebase is None else codebase
+        chunk_codes = [codebase[i][k] for k in maxinds]
         chunk_sims = chunk_sims[0][maxinds]
         codes.extend(chunk_codes)
         sims.extend(chunk_sims)
@@ -275,15 +473,37 @@ class CodeSearcher:
 
 def parse_args():
     parser = argparse.ArgumentParser("Train and Test Code Search(Embedding) Model")
-    parser.add_argument("--mode", choices=["train", "eval", "repr_code", "search"], default='train',
+    parser.add_argument("--mode", choices=["train", "eval", "repr_code", "search", "batch_search",
+                                           "add_segment", "delete", "compact", "bundle"],
+                        default='train',
                         help="The mode to run. The `train` mode trains a model;"
                              " the `eval` mode evaluat models in a test set "
                              " The `repr_code/repr_desc` mode computes vectors"
-                             " for a code snippet or a natural language description with a trained model.")
+                             " for a code snippet or a natural language description with a trained model."
+                             " The `batch_search` mode searches every query of a file and writes json lines."
+                             " The `add_segment`, `delete` and `compact` modes update the segmented index."
+                             " The `bundle` mode writes code vectors, raw code, vocabulary and encoder to one file.")
     parser.add_argument("--verbose", action="store_true", default=True, help="Be verbose")
     parser.add_argument("--language", choices=["java", "python"], default="java",
                         help="Language to train the models on")
-    return parser.parse_args()
+    parser.add_argument("--queries", help="File with one query per line, for `batch_search`")
+    parser.add_argument("--out", help="Output file: json lines for `batch_search`, the index bundle for `bundle`")
+    parser.add_argument("--n_results", type=int, default=10,
+                        help="Number of results per query, for `batch_search`")
+    parser.add_argument("--segments", action="store_true", default=False,
+                        help="Search the segmented index instead of `use_codevecs`")
+    parser.add_argument("--ids", help="File with one code id per line, for `delete`")
+    parser.add_argument("--bundle", help="Index bundle to search, instead of the files in the workdir")
+    parser.add_argument("--watch", help="Directory of `*.bundle` index versions: search the newest one"
+                                        " and hot reload newer ones as they appear")
+    args = parser.parse_args()
+    if args.mode == 'batch_search' and (args.queries is None or args.out is None):
+        parser.error("--mode batch_search requires --queries and --out")
+    if args.mode == 'delete' and args.ids is None:
+        parser.error("--mode delete requires --ids")
+    if args.mode == 'bundle' and args.out is None:
+        parser.error("--mode bundle requires --out")
+    return args
 
 
 if __name__ == '__main__':
@@ -296,12 +516,17 @@ if __name__ == '__main__':
     else:
         conf = get_python_config()
         data_loader_class = CodeSearchPythonDataSet
-    searcher = CodeSearcher(conf)
+    if args.watch is not None:
+        args.bundle = latest_bundle(args.watch)
+        assert args.bundle is not None, 'No index bundle found in {}'.format(args.watch)
+    searcher = CodeSearcher(conf, bundle=args.bundle)
 
     ##### Define model ######
     logger.info('Build Model')
     model = JointEmbedding(conf)  # initialize the model
-    if conf['reload'] > 0:
+    if searcher.bundle is not None:
+        searcher.bundle.load_desc_encoder(model)
+    elif conf['reload'] > 0:
         searcher.load_model(model, conf['reload'])
 
     model = model.cuda() if torch.cuda.is_available() else model
@@ -318,10 +543,30 @@ if __name__ == '__main__':
     elif args.mode == 'repr_code':
         vecs = searcher.repr_code(model.eval(), data_loader_class)
 
+    elif args.mode == 'add_segment':
+        searcher.add_segment(model.eval(), data_loader_class)
+
+    elif args.mode == 'delete':
+        searcher.load_index()
+        searcher.index.delete(np.loadtxt(args.ids, dtype='int64', ndmin=1))
+
+    elif args.mode == 'compact':
+        searcher.load_index()
+        searcher.index.compact()
+
+    elif args.mode == 'bundle':
+        searcher.save_bundle(model, args.out)
+
     elif args.mode == 'search':
         # search code based on a desc
-        searcher.load_codevecs()
-        searcher.load_codebase()
+        if args.watch is not None:
+            searcher.watch(model.eval(), args.watch, conf['reload_interval'])
+        if args.segments:
+            searcher.load_index()
+            searcher.index.start_compaction()
+        elif searcher.bundle is None:
+            searcher.load_codevecs()
+            searcher.load_codebase()
         while True:
             try:
                 query = input('Input Query: ')
@@ -334,3 +579,13 @@ if __name__ == '__main__':
             zipped = zip(codes, sims)
             results = '\n\n'.join(map(str, zipped))  # combine the result into a returning string
             print(results)
+
+    elif args.mode == 'batch_search':
+        if args.watch is not None:
+            searcher.watch(model.eval(), args.watch, conf['reload_interval'])
+        if args.segments:
+            searcher.load_index()
+        elif searcher.bundle is None:
+            searcher.load_codevecs()
+            searcher.load_codebase_offsets()
+        searcher.batch_search(model.eval(), args.queries, args.out, args.n_results)
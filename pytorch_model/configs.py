@@ -19,6 +19,8 @@ def get_java_config():
         'use_tokens': 'use.tokens.h5',
         # results data(code vectors)
         'use_codevecs': 'use.codevecs.normalized.h5',  # 'use.codevecs.h5',
+        # segmented index (incrementally updated code vectors + raw code)
+        'index_dir': 'index/',
 
         # parameters
         'name_len': 6,
@@ -61,6 +63,11 @@ def get_java_config():
         'margin': 0.05,
         'sim_measure': 'cos',  # similarity measure: gesd, cosine, aesd
 
+        # search_params
+        'search_batch_size': 512,  # number of queries encoded and scored together in batch_search
+        'search_block_size': 100000,  # code vectors scored per GEMM, bounds the similarity matrix
+        'reload_interval': 60,  # seconds between checks for a new index bundle (--watch)
+
     }
     return conf
 
@@ -86,6 +93,8 @@ def get_python_config():
         'use_tokens': 'train.apiseq.npy',
         # results data(code vectors)
         'use_codevecs': 'use.codevecs.normalized.h5',  # 'use.codevecs.h5',
+        # segmented index (incrementally updated code vectors + raw code)
+        'index_dir': 'index/',
 
         # parameters
         'name_len': 5,
@@ -128,5 +137,10 @@ def get_python_config():
         'margin': 0.05,
         'sim_measure': 'cos',  # similarity measure: gesd, cosine, aesd
 
+        # search_params
+        'search_batch_size': 512,  # number of queries encoded and scored together in batch_search
+        'search_block_size': 100000,  # code vectors scored per GEMM, bounds the similarity matrix
+        'reload_interval': 60,  # seconds between checks for a new index bundle (--watch)
+
     }
     return conf
@@ -147,6 +147,42 @@ def load_vecs(fin):
     return vecs
 
 
+def load_line_offsets(fin, chunk_size=1 << 24):
+    """byte offsets of the lines of a text file: line i spans offsets[i]:offsets[i + 1]"""
+    starts = [np.zeros(1, dtype='int64')]
+    pos = 0
+    with open(fin, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            starts.append(newlines.astype('int64') + (pos + 1))
+            pos += len(chunk)
+    offsets = np.concatenate(starts)
+    if offsets[-1] != pos:  # last line has no trailing newline
+        offsets = np.append(offsets, pos)
+    return offsets
+
+
+class SnippetStore:
+    """raw code snippets stored back to back in a (memory mapped) buffer, addressed by byte offsets"""
+
+    def __init__(self, buf, offsets):
+        self.buf = buf
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            assert step == 1, 'Snippet slices must be contiguous'
+            return SnippetStore(self.buf, self.offsets[start:stop + 1])
+        return bytes(self.buf[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8', errors='replace')
+
+
 def save_vecs(vecs, fout):
     fvec = tables.open_file(fout, 'w')
     atom = tables.Atom.from_dtype(vecs.dtype)
@@ -0,0 +1,318 @@
+import contextlib
+import fcntl
+import json
+import logging
+import mmap
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from data import SnippetStore
+from utils import block_topk, merge_topk
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'MANIFEST.json'
+LOCK = 'LOCK'
+
+
+def _stamp(fname):
+    """identity of the current version of a file (files are only ever replaced), None if missing"""
+    try:
+        st = os.stat(fname)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _atomic_write(fname, write):
+    """write a file through a temporary file and rename it over the old one"""
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, fname)
+
+
+class Segment:
+    """
+    An immutable part of the search index: normalized code vectors, their ids and raw code.
+    Only the tombstone bitmap of deleted rows changes after a segment is written; it lives
+    next to the segment directory and is replaced (never modified) on every delete.
+    """
+
+    def __init__(self, path, name):
+        self.name = name
+        self.dir = os.path.join(path, name)
+        self.tombstone_file = self.dir + '.tombstones.npy'
+        self.vecs = np.load(os.path.join(self.dir, 'vecs.npy'), mmap_mode='r')
+        self.ids = np.load(os.path.join(self.dir, 'ids.npy'))  # sorted
+        self.offsets = np.load(os.path.join(self.dir, 'offsets.npy'))
+        self.code = b''
+        if self.offsets[-1]:  # empty files cannot be mapped
+            with open(os.path.join(self.dir, 'code.txt'), 'rb') as f:
+                self.code = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.snippets = SnippetStore(self.code, self.offsets)
+        self.deleted = np.zeros(len(self.ids), dtype=bool)
+        self.tombstone_stamp = None
+        self.load_tombstones()
+
+    def load_tombstones(self):
+        """read the tombstones again if another handle (or process) replaced them"""
+        stamp = _stamp(self.tombstone_file)
+        if stamp is not None and stamp != self.tombstone_stamp:
+            self.deleted = np.unpackbits(np.load(self.tombstone_file))[:len(self.ids)].astype(bool)
+            self.tombstone_stamp = stamp
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def n_live(self):
+        return len(self.ids) - int(self.deleted.sum())
+
+    def rows(self, ids):
+        """rows of the given ids in this segment, -1 where the id is not stored here"""
+        rows = np.searchsorted(self.ids, ids)
+        rows[rows == len(self.ids)] = 0
+        found = self.ids[rows] == ids if len(self.ids) else np.zeros(len(rows), dtype=bool)
+        return np.where(found, rows, -1)
+
+    def save_tombstones(self, deleted):
+        _atomic_write(self.tombstone_file, lambda f: np.save(f, np.packbits(deleted)))
+        self.deleted = deleted  # swap, readers keep the array they started with
+        self.tombstone_stamp = _stamp(self.tombstone_file)
+
+    @staticmethod
+    def write(path, name, vecs, ids, codes):
+        """write a new segment directory; `codes` are raw code snippets, one line each"""
+        order = np.argsort(ids, kind='stable')
+        tmp_dir = os.path.join(path, name + '.tmp')
+        os.makedirs(tmp_dir)
+        with open(os.path.join(tmp_dir, 'code.txt'), 'wb') as f:
+            lengths = np.zeros(len(ids), dtype='int64')
+            for i, k in enumerate(order):
+                code = codes[k] if isinstance(codes[k], bytes) else codes[k].encode('utf-8')
+                if not code.endswith(b'\n'):
+                    code += b'\n'
+                f.write(code)
+                lengths[i] = len(code)
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), np.concatenate(([0], np.cumsum(lengths))))
+        np.save(os.path.join(tmp_dir, 'ids.npy'), np.asarray(ids, dtype='int64')[order])
+        np.save(os.path.join(tmp_dir, 'vecs.npy'), np.asarray(vecs)[order])
+        os.rename(tmp_dir, os.path.join(path, name))
+        return Segment(path, name)
+
+
+class SegmentedIndex:
+    """
+    Code search index made of immutable segments.
+    New code is added as a new segment, deleted code is recorded in tombstone bitmaps and
+    `compact` merges segments (dropping deleted rows) so that updates cost time proportional
+    to their size. Readers take the current list of segments once per search, writers replace
+    that list, so searches run concurrently with `add`, `delete` and `compact`.
+
+    Several handles (e.g. processes) can open the same directory: writers hold a lock file and
+    read the manifest and tombstones again before changing them, and searches pick up the
+    segments and tombstones written by other handles.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()  # serializes the writers of this handle
+        self._state_lock = threading.RLock()  # serializes the updates of `manifest` and `segments`
+        self._compaction = None
+        self._stop_compaction = threading.Event()
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.manifest_file = os.path.join(self.path, MANIFEST)
+        self.manifest_stamp = None
+        self.manifest = {'version': 1, 'next_id': 0, 'next_segment': 0, 'segments': []}
+        self.segments = []
+        self.refresh()
+        logger.info('Loaded {} segments ({} live vectors)'.format(len(self.segments), self.n_live))
+
+    @property
+    def n_live(self):
+        return sum(segment.n_live for segment in self.segments)
+
+    @contextlib.contextmanager
+    def _write_lock(self):
+        """lock out the writers of this and every other handle, and read their changes"""
+        with self.lock, open(os.path.join(self.path, LOCK), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def refresh(self):
+        """read the manifest and tombstones again if another handle changed them"""
+        for _ in range(3):
+            try:
+                with self._state_lock:
+                    self._refresh()
+                return
+            except FileNotFoundError:
+                # a segment listed by the manifest just read was compacted away, read the new one
+                continue
+        raise RuntimeError('Index {} changed while being read'.format(self.path))
+
+    def _refresh(self):
+        stamp = _stamp(self.manifest_file)
+        if stamp is not None and stamp != self.manifest_stamp:
+            with open(self.manifest_file) as f:
+                manifest = json.load(f)
+            loaded = {segment.name: segment for segment in self.segments}
+            self.segments = [loaded.get(name) or Segment(self.path, name) for name in manifest['segments']]
+            self.manifest, self.manifest_stamp = manifest, stamp
+        for segment in self.segments:
+            segment.load_tombstones()
+
+    def _save_manifest(self, segments):
+        with self._state_lock:
+            self.manifest['segments'] = [segment.name for segment in segments]
+            data = json.dumps(self.manifest, indent=2).encode('utf-8')
+            _atomic_write(self.manifest_file, lambda f: f.write(data))
+            self.manifest_stamp = _stamp(self.manifest_file)
+            self.segments = segments
+
+    def _new_segment_name(self):
+        name = 'seg-%06d' % self.manifest['next_segment']
+        self.manifest['next_segment'] += 1
+        return name
+
+    def add(self, vecs, codes, ids=None):
+        """add normalized code vectors and their raw code as a new segment, return their ids"""
+        assert len(vecs) == len(codes), 'Got {} vectors for {} snippets'.format(len(vecs), len(codes))
+        if not len(vecs):
+            return np.zeros(0, dtype='int64')
+        with self._write_lock():
+            if ids is None:
+                ids = np.arange(self.manifest['next_id'], self.manifest['next_id'] + len(vecs))
+            ids = np.asarray(ids, dtype='int64')
+            self.manifest['next_id'] = max(self.manifest['next_id'], int(ids.max()) + 1)
+            segment = Segment.write(self.path, self._new_segment_name(), vecs, ids, codes)
+            self._save_manifest(self.segments + [segment])
+        logger.info('Added segment {} with {} vectors'.format(segment.name, len(segment)))
+        return ids
+
+    def delete(self, ids):
+        """tombstone the given ids in every segment that holds them, return the number deleted"""
+        ids = np.asarray(ids, dtype='int64')
+        n_deleted = 0
+        with self._write_lock():
+            for segment in self.segments:
+                rows = segment.rows(ids)
+                rows = rows[rows >= 0]
+                rows = rows[~segment.deleted[rows]]
+                if len(rows):
+                    deleted = segment.deleted.copy()
+                    deleted[rows] = True
+                    segment.save_tombstones(deleted)
+                    n_deleted += len(rows)
+        logger.info('Deleted {} vectors'.format(n_deleted))
+        return n_deleted
+
+    def search(self, desc_reprs, n_results, block_size):
+        """
+        ids and similarities of the top `n_results` live code vectors for each normalized query
+        vector, merged over all segments. Missing results (fewer live vectors than `n_results`)
+        have id -1 and similarity -inf.
+        """
+        self.refresh()
+        inds, sims = None, None
+        segments = [segment for segment in self.segments if len(segment)]
+        for segment in segments:
+            seg_inds, seg_sims = block_topk(desc_reprs, segment.vecs, n_results, block_size,
+                                            deleted=segment.deleted)
+            inds, sims = merge_topk(inds, sims, segment.ids[seg_inds], seg_sims, n_results)
+        if inds is None:
+            return np.full((len(desc_reprs), 0), -1, dtype='int64'), np.zeros((len(desc_reprs), 0))
+        inds[np.isneginf(sims)] = -1
+        return inds, sims
+
+    def locate(self, code_id):
+        """(segment, row) that holds a live id, or (None, -1)"""
+        for segment in self.segments:
+            row = segment.rows(np.array([code_id]))[0]
+            if row >= 0 and not segment.deleted[row]:
+                return segment, row
+        return None, -1
+
+    def snippet(self, code_id):
+        segment, row = self.locate(code_id)
+        return segment.snippets[row] if segment is not None else None
+
+    ##### Compaction #####
+    def compact(self):
+        """
+        merge all segments into one, dropping deleted rows. Rows deleted while the merged
+        segment is being written are tombstoned in it before it replaces the old ones.
+        """
+        with self._write_lock():
+            old = list(self.segments)
+            if len(old) <= 1 and all(segment.n_live == len(segment) for segment in old):
+                return False
+            name = self._new_segment_name()
+            self._save_manifest(old)  # reserves the name for the other handles
+            snapshot = [segment.deleted for segment in old]
+        vecs, ids, codes = [], [], []
+        for segment, deleted in zip(old, snapshot):
+            rows = np.flatnonzero(~deleted)
+            vecs.append(segment.vecs[rows])
+            ids.append(segment.ids[rows])
+            codes.extend(segment.code[segment.offsets[r]:segment.offsets[r + 1]] for r in rows)
+        merged = Segment.write(self.path, name, np.concatenate(vecs), np.concatenate(ids), codes)
+        with self._write_lock():
+            if not all(segment in self.segments for segment in old):
+                # another handle compacted these segments meanwhile
+                shutil.rmtree(merged.dir)
+                logger.info('Segments were compacted by another handle, dropping {}'.format(merged.name))
+                return False
+            deleted_since = [segment.ids[segment.deleted & ~deleted]
+                             for segment, deleted in zip(old, snapshot)]
+            rows = merged.rows(np.concatenate(deleted_since))
+            if (rows >= 0).any():
+                deleted = merged.deleted.copy()
+                deleted[rows[rows >= 0]] = True
+                merged.save_tombstones(deleted)
+            self._save_manifest([merged] + [s for s in self.segments if s not in old])
+        for segment in old:
+            shutil.rmtree(segment.dir)
+            if os.path.exists(segment.tombstone_file):
+                os.remove(segment.tombstone_file)
+        logger.info('Compacted {} segments into {} ({} vectors)'.format(len(old), merged.name, len(merged)))
+        return True
+
+    def needs_compaction(self, max_segments, max_deleted_ratio):
+        segments = self.segments
+        n_rows = sum(len(segment) for segment in segments)
+        n_deleted = n_rows - sum(segment.n_live for segment in segments)
+        return len(segments) > max_segments or (n_rows and n_deleted / n_rows > max_deleted_ratio)
+
+    def start_compaction(self, interval=600, max_segments=8, max_deleted_ratio=0.2):
+        """compact in a background thread every `interval` seconds when the index needs it"""
+
+        def compaction_loop():
+            while not self._stop_compaction.wait(interval):
+                try:
+                    self.refresh()
+                    if self.needs_compaction(max_segments, max_deleted_ratio):
+                        self.compact()
+                except Exception:
+                    logger.exception('Compaction failed')
+
+        self._stop_compaction.clear()
+        self._compaction = threading.Thread(target=compaction_loop, daemon=True)
+        self._compaction.start()
+
+    def stop_compaction(self):
+        if self._compaction is not None:
+            self._stop_compaction.set()
+            self._compaction.join()
+            self._compaction = None
@@ -4,6 +4,8 @@ import time
 import numpy as np
 import torch
 
+from data import PAD_token, UNK_token
+
 
 def cos_np(data1, data2):
     """numpy implementation of cosine similarity for matrix"""
@@ -26,6 +28,41 @@ def dot_np(data1, data2):
     return np.dot(data1, np.transpose(data2))
 
 
+def topk_np(sims, k):
+    """indices and values of the k largest entries of each row, best first"""
+    k = min(k, sims.shape[1])
+    inds = np.argpartition(np.negative(sims), kth=k - 1, axis=1)[:, :k]
+    vals = np.take_along_axis(sims, inds, axis=1)
+    order = np.argsort(np.negative(vals), axis=1, kind='stable')
+    return np.take_along_axis(inds, order, axis=1), np.take_along_axis(vals, order, axis=1)
+
+
+def merge_topk(inds1, sims1, inds2, sims2, k):
+    """merge two per-row top-k results into a single top-k"""
+    if inds1 is None:
+        return inds2, sims2
+    inds = np.concatenate((inds1, inds2), axis=1)
+    sims = np.concatenate((sims1, sims2), axis=1)
+    best, sims = topk_np(sims, k)
+    return np.take_along_axis(inds, best, axis=1), sims
+
+
+def block_topk(queries, vecs, k, block_size, offset=0, deleted=None):
+    """top-k rows of `vecs` for each (normalized) query, scored `block_size` rows at a time
+       so that the similarity matrix never exceeds len(queries) x block_size
+       deleted: optional boolean mask of rows that must never be returned (they score -inf)
+       return: (indices shifted by `offset`, similarities), both of shape [n_queries x k]
+    """
+    inds, sims = None, None
+    for start in range(0, vecs.shape[0], block_size):
+        block_sims = dot_np(queries, vecs[start:start + block_size])
+        if deleted is not None:
+            block_sims[:, deleted[start:start + block_size]] = -np.inf
+        block_inds, block_sims = topk_np(block_sims, k)
+        inds, sims = merge_topk(inds, sims, block_inds + (offset + start), block_sims, k)
+    return inds, sims
+
+
 #######################################################################
 
 def asMinutes(s):
@@ -44,11 +81,23 @@ def timeSince(since, percent):
 
 #######################################################################
 
-def sent2indexes(sentence, vocab):
+def sent2indexes(sentence, vocab, unk=UNK_token):
     '''sentence: a string
-       return: a numpy array of word indices
+       return: a numpy array of word indices; unknown words map to `unk`, like in `sents2indexes`
+    '''
+    return np.array([vocab.get(word, unk) for word in sentence.strip().split(' ')])
+
+
+def sents2indexes(sentences, vocab, maxlen, pad=PAD_token, unk=UNK_token):
+    '''sentences: a list of strings
+       return: a [len(sentences) x maxlen] int64 array of word indices, post-padded with `pad`;
+       unknown words map to `unk` instead of raising
     '''
-    return np.array([vocab[word] for word in sentence.strip().split(' ')])
+    indexes = np.full((len(sentences), maxlen), pad, dtype='int64')
+    for i, sentence in enumerate(sentences):
+        words = sentence.strip().split(' ')[:maxlen]
+        indexes[i, :len(words)] = [vocab.get(word, unk) for word in words]
+    return indexes
 
 
 ########################################################################